@@ -0,0 +1,93 @@
+"""Admission of received DHCP packets by priority class
+
+When packets arrive faster than they are handled, keeping existing clients
+renewing matters more than offering addresses to new ones. Packets wait in
+one queue per class, higher classes are served more often and the lowest
+class is shed first when the queues are full.
+"""
+
+import collections
+
+# classes in priority order
+RENEWING = 0   # DHCPREQUEST of a client holding an address, RENEWING, REBINDING, INIT-REBOOT
+SELECTING = 1  # DHCPREQUEST answering an offer, carries server identifier
+DISCOVER = 2
+INFORM = 3     # DHCPINFORM and other messages
+
+class_names = ('renewing', 'selecting', 'discover', 'inform')
+
+def classify(packet):
+    """Get priority class of packet, see RFC 2131 4.3.2 for DHCPREQUEST states
+    """
+    message_type = packet.dhcp_message_type
+    if message_type == 'DHCPREQUEST':
+        if packet.get_option_bytes(54) is not None:
+            return SELECTING
+        return RENEWING
+    if message_type == 'DHCPDISCOVER':
+        return DISCOVER
+    return INFORM
+
+class AdmissionQueue(object):
+    """Bounded queues of packets per priority class
+    At most capacity packets wait in all queues together. A packet arriving
+    at full queues sheds the oldest packet of the lowest class below its own,
+    it is dropped if there is none. Serving takes up to weights[class]
+    packets of every class in turn.
+    """
+    def __init__(self, capacity = 1024, weights = (8, 4, 2, 1), read_batch = 256, serve_batch = 64):
+        self.capacity = capacity
+        self.weights = weights
+        # packets read from sockets and served per server update
+        self.read_batch = read_batch
+        self.serve_batch = serve_batch
+        self.queues = [collections.deque() for name in class_names]
+        self.depth = 0
+        self.admitted = [0] * len(class_names)
+        self.drops = [0] * len(class_names)
+
+    def __len__(self):
+        return self.depth
+
+    def put(self, packet):
+        """Queue packet, False if it was dropped
+        """
+        priority = classify(packet)
+        if self.depth >= self.capacity:
+            for lower in range(len(self.queues) - 1, priority, -1):
+                if self.queues[lower]:
+                    self.queues[lower].popleft()
+                    self.drops[lower] += 1
+                    break
+            else:
+                self.drops[priority] += 1
+                return False
+        else:
+            self.depth += 1
+        self.queues[priority].append(packet)
+        self.admitted[priority] += 1
+        return True
+
+    def serve(self, handle, budget = None):
+        """Call handle with up to budget queued packets, all if budget is None,
+        returns the number of packets handled
+        """
+        served = 0
+        while self.depth and (budget is None or served < budget):
+            for queue, weight in zip(self.queues, self.weights):
+                for i in range(min(weight, len(queue))):
+                    if budget is not None and served >= budget:
+                        return served
+                    packet = queue.popleft()
+                    self.depth -= 1
+                    served += 1
+                    handle(packet)
+        return served
+
+    def statistics(self):
+        statistics = {'admission_depth': self.depth}
+        for name, queue, admitted, drops in zip(class_names, self.queues, self.admitted, self.drops):
+            statistics['admission_{}_depth'.format(name)] = len(queue)
+            statistics['admission_{}_admitted'.format(name)] = admitted
+            statistics['admission_{}_drops'.format(name)] = drops
+        return statistics
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""Batch decoding of DHCP datagrams into columns for traffic analysis
+
+Summarize a capture:
+./batch.py capture.pcapng
+"""
+
+import array
+import collections
+import struct
+import sys
+
+from listener import *
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# column name -> array.array type code, all addresses are integers
+columns = {
+    'valid': 'B',                        # 1 if datagram is long enough to be DHCP
+    'transaction_id': 'I',
+    'dhcp_message_type': 'B',            # 0 if option is missing
+    'chaddr': 'Q',
+    'ciaddr': 'I',
+    'giaddr': 'I',
+    'requested_ip': 'I',                 # 0 if option is missing
+    'parameter_request_fingerprint': 'I' # FNV-1a of parameter_request_list, 0 if missing
+}
+
+def decode_batch(buffers, use_numpy = True):
+    """Decode sequence of datagrams into dict of column name -> array
+    Row i of every column belongs to buffers[i]. Columns are numpy arrays
+    if numpy is installed and use_numpy is set, array.array otherwise
+    """
+    buffers = list(buffers)
+    if numpy is not None and use_numpy:
+        return _decode_numpy(buffers)
+    return _decode_array(buffers)
+
+FNV_OFFSET = 2166136261
+FNV_PRIME = 16777619
+
+def fingerprint(data):
+    """32 bit FNV-1a hash used as parameter_request_list fingerprint
+    """
+    result = FNV_OFFSET
+    for byte in data:
+        result = (result ^ byte) * FNV_PRIME & 0xffffffff
+    return result
+
+def _decode_options(buffer):
+    """Get (dhcp_message_type, requested_ip, parameter_request_fingerprint) of datagram,
+    all 0 if its options can not be decoded
+    """
+    try:
+        return _scan_options(buffer)
+    except (IndexError, struct.error):
+        # malformed datagram, the rest of the batch is decoded
+        return 0, 0, 0
+
+def _scan_options(buffer):
+    # options cut off by the end of the datagram count as missing
+    option_offsets = {option: index for option, index in scan_options(buffer).items()
+                      if index + buffer[index - 1] <= len(buffer)}
+    message_type = requested_ip = parameter_request_fingerprint = 0
+    index = option_offsets.get(53)
+    if index is not None and buffer[index - 1]:
+        message_type = buffer[index]
+    index = option_offsets.get(50)
+    if index is not None and buffer[index - 1] == 4:
+        requested_ip = struct.unpack_from('>I', buffer, index)[0]
+    index = option_offsets.get(55)
+    if index is not None:
+        parameter_request_fingerprint = fingerprint(buffer[index:index + buffer[index - 1]])
+    return message_type, requested_ip, parameter_request_fingerprint
+
+header = struct.Struct('>4xI4xI8xI')
+
+def _decode_array(buffers):
+    result = {name: array.array(code) for name, code in columns.items()}
+    valid, transaction_id, message_type, chaddr, ciaddr, giaddr, requested_ip, fingerprint = \
+        [result[name].append for name in columns]
+    for buffer in buffers:
+        if len(buffer) < 240:
+            for append in (valid, transaction_id, message_type, chaddr, ciaddr, giaddr, requested_ip, fingerprint):
+                append(0)
+            continue
+        xid, client_ip, relay_ip = header.unpack_from(buffer)
+        valid(1)
+        transaction_id(xid)
+        ciaddr(client_ip)
+        giaddr(relay_ip)
+        chaddr(int.from_bytes(buffer[28:34], 'big'))
+        options = _decode_options(buffer)
+        message_type(options[0])
+        requested_ip(options[1])
+        fingerprint(options[2])
+    return result
+
+def _decode_numpy(buffers, chunk_size = 65536):
+    chunks = [_decode_numpy_chunk(buffers[start:start + chunk_size])
+              for start in range(0, len(buffers), chunk_size)] or [_decode_numpy_chunk([])]
+    return {name: numpy.concatenate([chunk[name] for chunk in chunks]) for name in columns}
+
+def _decode_numpy_chunk(buffers):
+    count = len(buffers)
+    lengths = numpy.fromiter(map(len, buffers), dtype = 'int64', count = count)
+    # all datagrams padded to the same width in one matrix
+    width = max(240, int(lengths.max()) if count else 0) + 8
+    matrix = numpy.frombuffer(b''.join(bytes(buffer).ljust(width, b'\0') for buffer in buffers),
+                              dtype = 'uint8').reshape(count, width)
+
+    def field(start, size):
+        big_endian = numpy.ascontiguousarray(matrix[:, start:start + size]).view('>u{}'.format(size))
+        return big_endian.ravel().astype('uint{}'.format(size * 8))
+
+    valid = lengths >= 240
+    result = {'valid': valid.astype('uint8'),
+              'transaction_id': field(4, 4),
+              'ciaddr': field(12, 4),
+              'giaddr': field(24, 4),
+              'chaddr': field(28, 2).astype('uint64') << numpy.uint64(32) | field(30, 4).astype('uint64')}
+    for name in ('transaction_id', 'ciaddr', 'giaddr', 'chaddr'):
+        result[name][~valid] = 0
+
+    # walk the options of all datagrams at once, one option per step
+    message_type = numpy.zeros(count, dtype = 'uint8')
+    requested_ip = numpy.zeros(count, dtype = 'uint32')
+    request_start = numpy.zeros(count, dtype = 'int64')
+    request_length = numpy.full(count, -1, dtype = 'int64')
+    overloaded = numpy.zeros(count, dtype = bool)
+    cursor = numpy.full(count, 240, dtype = 'int64')
+    rows = numpy.flatnonzero(valid)
+    while len(rows):
+        # datagrams whose option list ended drop out, padding advances by one byte
+        rows = rows[cursor[rows] + 1 < lengths[rows]]
+        code = matrix[rows, cursor[rows]]
+        rows = rows[code != 255]
+        code = matrix[rows, cursor[rows]]
+        padding = rows[code == 0]
+        cursor[padding] += 1
+        rows, code = rows[code != 0], code[code != 0]
+        start = cursor[rows] + 2
+        length = matrix[rows, start - 1].astype('int64')
+        # the last occurrence of an option wins, cut off options count as missing
+        complete = start + length <= lengths[rows]
+        selected = code == 53
+        value = matrix[rows[selected], start[selected]]
+        message_type[rows[selected]] = numpy.where(complete[selected] & (length[selected] > 0), value, 0)
+        selected = code == 50
+        value = numpy.zeros(numpy.count_nonzero(selected), dtype = 'uint32')
+        for byte in range(4):
+            value = value << numpy.uint32(8) | matrix[rows[selected], start[selected] + byte]
+        requested_ip[rows[selected]] = numpy.where(complete[selected] & (length[selected] == 4), value, 0)
+        selected = code == 55
+        request_start[rows[selected]] = start[selected]
+        request_length[rows[selected]] = numpy.where(complete[selected], length[selected], -1)
+        overloaded[rows[code == 52]] = True
+        cursor[rows] = start + length
+        rows = numpy.concatenate([rows, padding])
+
+    # FNV-1a of parameter_request_list, one byte of all lists per step
+    parameter_request_fingerprint = numpy.zeros(count, dtype = 'uint64')
+    rows = numpy.flatnonzero(request_length >= 0)
+    parameter_request_fingerprint[rows] = FNV_OFFSET
+    for index in range(int(request_length.max()) if count else 0):
+        rows = rows[request_length[rows] > index]
+        value = parameter_request_fingerprint[rows] ^ matrix[rows, request_start[rows] + index].astype('uint64')
+        parameter_request_fingerprint[rows] = value * numpy.uint64(FNV_PRIME) & numpy.uint64(0xffffffff)
+
+    # options continued in file and sname fields are rare, decode them one by one
+    parameter_request_fingerprint = parameter_request_fingerprint.astype('uint32')
+    for row in numpy.flatnonzero(overloaded):
+        message_type[row], requested_ip[row], parameter_request_fingerprint[row] = _decode_options(buffers[row])
+    result['dhcp_message_type'] = message_type
+    result['requested_ip'] = requested_ip
+    result['parameter_request_fingerprint'] = parameter_request_fingerprint
+    return {name: result[name] for name in columns}
+
+# a malformed datagram between valid ones leaves them intact
+_valid = bytes(236) + b'\x63\x82\x53\x63' + bytes([53, 1, 1, 255])
+_batch = decode_batch([_valid, _valid[:240] + bytes([53, 1, 3, 52, 1]), _valid], use_numpy = False)
+assert list(_batch['valid']) == [1, 1, 1] and list(_batch['dhcp_message_type']) == [1, 3, 1]
+if numpy is not None:
+    _batch = decode_batch([_valid, _valid[:240] + bytes([53, 1, 3, 52, 1]), _valid])
+    assert list(_batch['dhcp_message_type']) == [1, 3, 1]
+del _valid, _batch
+
+if __name__ == '__main__':
+    from capture import PcapReader
+    if len(sys.argv) < 2:
+        print('usage: batch.py capture.pcap')
+        sys.exit(1)
+    with PcapReader(sys.argv[1]) as reader:
+        batch = decode_batch(payload for timestamp, payload, address in reader)
+    print('datagrams: {}'.format(len(batch['valid'])))
+    message_types = collections.Counter(batch['dhcp_message_type'][i] for i, valid in enumerate(batch['valid']) if valid)
+    for message_type, count in sorted(message_types.items()):
+        print('{}: {}'.format(dhcp_message_types.get(message_type, message_type), count))
+    print('clients: {}'.format(len(set(batch['chaddr']))))
+    print('parameter request lists: {}'.format(len(set(batch['parameter_request_fingerprint']))))
@@ -0,0 +1,422 @@
+#!/usr/bin/env python3
+"""Micro benchmarks of the DHCP server hot paths
+
+Run all benchmarks:
+./benchmark.py
+or only some of them:
+./benchmark.py packet_memory
+"""
+
+import base64
+import struct
+import sys
+import time
+import timeit
+import tracemalloc
+
+from listener import *
+from dhcp import DHCPServerConfiguration, WriteBootProtocolPacket
+
+# fields dhcp.py reads from a DHCPDISCOVER / DHCPREQUEST
+used_fields = ('transaction_id', 'message_type', 'dhcp_message_type', 'client_mac_address',
+               'parameter_request_list', 'requested_ip_address', 'host_name',
+               'relay_agent_ip_address', 'client_ip_address', 'bootp_flags')
+
+def client_packet(transaction_id = 0x3903f326, mac = 0x00163e000001, message_type = 'DHCPDISCOVER',
+                  requested_ip_address = None, parameter_request_list = (1, 3, 6, 15, 28, 51, 58, 59)):
+    """Build client -> server datagram like a typical DHCP client does
+    """
+    result = bytearray(240)
+    result[0:4] = bytes([1, 1, 6, 0])
+    struct.pack_into('>I', result, 4, transaction_id)
+    result[28:34] = mac.to_bytes(6, 'big')
+    result[236:240] = inet_aton('99.130.83.99')
+    result += bytes([53, 1, reversed_dhcp_message_types[message_type]])
+    result += bytes([61, 7, 1]) + mac.to_bytes(6, 'big')
+    if requested_ip_address:
+        result += bytes([50, 4]) + inet_aton(requested_ip_address)
+    result += bytes([12, 4]) + b'host'
+    result += bytes([55, len(parameter_request_list)]) + bytes(parameter_request_list)
+    result += bytes([255])
+    result += bytes(max(0, 300 - len(result)))
+    return bytes(result)
+
+def overloaded_packet():
+    """Build client -> server datagram carrying options in file and sname fields
+    """
+    result = bytearray(client_packet()[:240])
+    result[108:118] = bytes([12, 4]) + b'host' + bytes([55, 1, 1, 255])
+    result[44:47] = bytes([61, 7, 1])
+    result[47:54] = bytes(6) + bytes([255])
+    result += bytes([52, 1, 3, 53, 1, 1, 255])
+    return bytes(result)
+
+class BaselineBootProtocolPacket(object):
+    """Copy of the parser packets were read with before the __slots__ classes,
+    every header field and option decoded into the instance __dict__, kept to
+    compare against
+    """
+    for i, o in enumerate(options):
+        locals()[o[0]] = None
+        locals()['option_{0}'.format(i)] = None
+    del i, o
+
+    @staticmethod
+    def macunpack(data):
+        s = base64.b16encode(data)
+        return ':'.join([s[i:i+2].decode('ascii') for i in range(0, 12, 2)])
+
+    @staticmethod
+    def shortunpack(data):
+        return data[0] << 8 | data[1]
+
+    def __init__(self, data, address = ('0.0.0.0', 0)):
+        self.data = data
+        self.address = address
+        self.host = address[0]
+        self.port = address[1]
+
+        self.message_type = self.OP =                data[0]
+        self.hardware_type = self.HTYPE =            data[1]
+        self.hardware_address_length = self.HLEN =   data[2]
+        self.hops = self.HOPS =                      data[3]
+
+        self.XID = self.transaction_id = struct.unpack('>I', data[4:8])[0]
+
+        self.seconds_elapsed = self.SECS = self.shortunpack(data[8:10])
+        self.bootp_flags = self.FLAGS =    self.shortunpack(data[8:10])
+
+        self.client_ip_address = self.CIADDR = inet_ntoa(data[12:16])
+        self.your_ip_address   = self.YIADDR = inet_ntoa(data[16:20])
+        self.next_server_ip_address = self.SIADDR = inet_ntoa(data[20:24])
+        self.relay_agent_ip_address = self.GIADDR = inet_ntoa(data[24:28])
+
+        self.client_mac_address = self.CHADDR = self.macunpack(data[28: 28 + self.hardware_address_length])
+        index = 236
+        self.magic_cookie = self.magic_cookie = inet_ntoa(data[index:index + 4]); index += 4
+        self.options = dict()
+        self.named_options = dict()
+        while index < len(data):
+            option = data[index]; index += 1
+            if option == 0:
+                continue
+            if option == 255:
+                break
+            option_length = data[index]; index += 1
+            option_data = data[index: index + option_length]; index += option_length
+            self.options[option] = option_data
+            if option < len(options):
+                option_name, function, _ = options[option]
+                if function:
+                    option_data = function(option_data)
+                if option_name:
+                    setattr(self, option_name, option_data)
+                    self.named_options[option_name] = option_data
+            setattr(self, 'option_{}'.format(option), option_data)
+
+packet_classes = (BaselineBootProtocolPacket, ReadBootProtocolPacket, LazyBootProtocolPacket)
+
+def best_time(function, count, repeat = 5):
+    """Get seconds one call of function takes, best of repeat runs
+    """
+    return min(timeit.repeat(function, number = count // repeat, repeat = repeat)) / (count // repeat)
+
+def report(name, **values):
+    """Print one benchmark result line
+    """
+    print('{:<40} {}'.format(name, '  '.join('{}={}'.format(key, value) for key, value in values.items())))
+
+def packet_memory(count = 10000):
+    """Bytes and allocations retained per parsed packet, before and after __slots__
+    """
+    for cls in packet_classes:
+        for fields in (('transaction_id', 'dhcp_message_type'), used_fields):
+            datagrams = [bytes(data) for i in range(count)]
+            packets = []
+            tracemalloc.start()
+            before = tracemalloc.take_snapshot()
+            for datagram in datagrams:
+                packet = cls(datagram)
+                for field in fields:
+                    getattr(packet, field)
+                packets.append(packet)
+            after = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            stats = after.compare_to(before, 'filename')
+            report('{} {} fields'.format(cls.__name__, len(fields)),
+                   bytes_per_packet = round(sum(stat.size_diff for stat in stats) / count, 1),
+                   allocations_per_packet = round(sum(stat.count_diff for stat in stats) / count, 2))
+
+def packet_parse(count = 100000):
+    """Parse time of one packet when only dispatch fields or all used fields are read
+    """
+    for cls in packet_classes:
+        for datagram, kind in ((data, ''), (overloaded_packet(), ' overloaded')):
+            for fields in (('transaction_id', 'dhcp_message_type'), used_fields):
+                def parse():
+                    packet = cls(datagram)
+                    for field in fields:
+                        getattr(packet, field)
+                report('{} {} fields{}'.format(cls.__name__, len(fields), kind),
+                       us_per_packet = round(best_time(parse, count) * 1e6, 2))
+
+def reply_configuration():
+    """Configuration with a typical set of options
+    """
+    configuration = DHCPServerConfiguration()
+    configuration.router = ['192.168.173.1']
+    configuration.domain_name_server = ['192.168.173.1', '192.168.173.2']
+    configuration.domain_name = b'example.org'
+    return configuration
+
+def build_reply(configuration, request):
+    """Build DHCPOFFER the way DHCPTransaction.send_offer does
+    """
+    offer = WriteBootProtocolPacket(configuration)
+    offer.parameter_order = request.parameter_request_list
+    offer.your_ip_address = '192.168.173.10'
+    offer.transaction_id = request.transaction_id
+    offer.relay_agent_ip_address = request.relay_agent_ip_address
+    offer.client_mac_address = request.client_mac_address
+    offer.client_ip_address = request.client_ip_address
+    offer.bootp_flags = request.bootp_flags
+    offer.dhcp_message_type = 'DHCPOFFER'
+    offer.client_identifier = request.client_mac_address
+    offer.server_identifier = '192.168.173.1'
+    return offer.to_bytes()
+
+def build_offer(configuration, request):
+    """Build DHCPOFFER packet without serializing it
+    """
+    offer = WriteBootProtocolPacket(configuration)
+    offer.parameter_order = request.parameter_request_list
+    offer.your_ip_address = '192.168.173.10'
+    offer.transaction_id = request.transaction_id
+    offer.client_mac_address = request.client_mac_address
+    offer.bootp_flags = request.bootp_flags
+    offer.dhcp_message_type = 'DHCPOFFER'
+    return offer
+
+def reply_serialize(count = 50000):
+    """Time to build and serialize one DHCPOFFER
+    """
+    configuration = reply_configuration()
+    request = LazyBootProtocolPacket(client_packet())
+    seconds = best_time(lambda: build_reply(configuration, request), count)
+    report('WriteBootProtocolPacket', us_per_reply = round(seconds * 1e6, 2),
+           template_hit_rate = round(WriteBootProtocolPacket.template_cache.hit_rate, 4))
+
+def batch_decode(count = 100000):
+    """Decode rate of captured datagrams, one object per packet versus columns
+    """
+    import batch
+    datagrams = [client_packet(transaction_id = i, mac = 0x00163e000000 + i % 5000) for i in range(count)]
+    def objects():
+        return [(packet.transaction_id, packet.dhcp_message_type, packet.chaddr, packet.ciaddr,
+                 packet.giaddr, packet.requested_ip, packet.parameter_request_list)
+                for packet in map(LazyBootProtocolPacket, datagrams)]
+    modes = [('LazyBootProtocolPacket objects', objects),
+             ('decode_batch array.array', lambda: batch.decode_batch(datagrams, use_numpy = False))]
+    if batch.numpy is not None:
+        modes.append(('decode_batch numpy', lambda: batch.decode_batch(datagrams)))
+    for name, function in modes:
+        seconds = best_time(function, 3, 3)
+        report(name, packets_per_second = int(count / seconds))
+
+def reply_send(count = 5000, port = 6767):
+    """Time to send one reply from every server address to unprivileged port,
+    sockets opened per reply like before versus persistent ReplySockets
+    """
+    from dhcp import ReplySockets, get_host_ip_addresses
+    offer = build_offer(reply_configuration(), LazyBootProtocolPacket(client_packet()))
+    def per_reply_sockets():
+        for address in get_host_ip_addresses():
+            broadcast_socket = socket(type = SOCK_DGRAM)
+            broadcast_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+            broadcast_socket.setsockopt(SOL_SOCKET, SO_BROADCAST, 1)
+            offer.server_identifier = address
+            broadcast_socket.bind((address, port))
+            try:
+                data = offer.to_bytes()
+                broadcast_socket.sendto(data, ('255.255.255.255', port + 1))
+                broadcast_socket.sendto(data, (address, port + 1))
+            finally:
+                broadcast_socket.close()
+    report('sockets per reply', us_per_reply = round(best_time(per_reply_sockets, count) * 1e6, 2))
+    reply_sockets = ReplySockets(port = port)
+    try:
+        seconds = best_time(lambda: reply_sockets.send(offer, port + 1), count)
+        statistics = reply_sockets.statistics()
+    finally:
+        reply_sockets.close()
+    report('ReplySockets', us_per_reply = round(seconds * 1e6, 2),
+           address_lookups = statistics['reply_address_lookups'],
+           sockets_opened = statistics['reply_sockets_opened'])
+
+def worker_throughput(seconds = 2, port = 6800, clients = 200, worker_counts = (1, 2, 4)):
+    """Unicast DHCPDISCOVERs handled per second by asyncio worker processes sharing
+    a loopback port, datagrams from many source ports are sent as fast as possible
+    """
+    import mmap
+    import os
+    import tempfile
+    from dhcp import AsyncioWorkerDHCPServer, Host, HostDatabase, start_workers, stop_workers
+    configuration = reply_configuration()
+    configuration.dhcp_offer_after_seconds = 0
+    configuration.client_rate_limit = None
+    host_file, configuration.host_file = tempfile.mkstemp(suffix = '.csv')
+    os.close(host_file)
+    # known clients, the host file is not written while measuring
+    hosts = HostDatabase(configuration.host_file)
+    for client in range(clients):
+        hosts.add(Host(0x020000000000 + client, ip_to_int('192.168.173.10') + client, 'host', 0))
+    datagrams = [client_packet(transaction_id = client, mac = 0x020000000000 + client) for client in range(clients)]
+    senders = [socket(type = SOCK_DGRAM) for i in range(64)]
+    counters = mmap.mmap(-1, 8 * max(worker_counts))
+
+    class CountingWorker(AsyncioWorkerDHCPServer):
+        def handle(self, packet):
+            super().handle(packet)
+            offset = 8 * self.worker
+            struct.pack_into('Q', counters, offset, struct.unpack_from('Q', counters, offset)[0] + 1)
+
+    try:
+        for workers in worker_counts:
+            counters[:] = bytes(len(counters))
+            pids = start_workers(configuration, workers, 'asyncio', port, CountingWorker)
+            time.sleep(0.5)
+            sent = 0
+            end = time.perf_counter() + seconds
+            while time.perf_counter() < end:
+                for datagram in datagrams:
+                    try:
+                        senders[sent % len(senders)].sendto(datagram, ('127.0.0.1', port))
+                    except BlockingIOError:
+                        pass
+                    sent += 1
+            time.sleep(0.5)
+            stop_workers(pids)
+            handled = struct.unpack_from('{}Q'.format(workers), counters)
+            report('{} worker processes'.format(workers), packets_per_second = int(sum(handled) / seconds),
+                   sent_per_second = int(sent / seconds), per_worker = '/'.join(map(str, handled)))
+    finally:
+        for sender in senders:
+            sender.close()
+        for suffix in ('', '.lock', '.leases'):
+            if os.path.exists(configuration.host_file + suffix):
+                os.remove(configuration.host_file + suffix)
+
+def delay_timers(counts = (10000, 100000, 1000000), span = 60.0, step = 0.01):
+    """Cost of pending delayed responses in TimerHeap and TimingWheel: insert,
+    cancel of every tenth and expiry of all by a clock advancing in steps
+    """
+    import random
+    from timers import TimerHeap, TimingWheel
+    for count in counts:
+        deadlines = [random.uniform(0, span) for i in range(count)]
+        for name, create in (('TimerHeap', TimerHeap), ('TimingWheel', lambda: TimingWheel(now = 0))):
+            timers = create()
+            started = time.perf_counter()
+            handles = [timers.add(deadline, None) for deadline in deadlines]
+            inserted = time.perf_counter()
+            for handle in handles[::10]:
+                handle.cancel()
+            cancelled = time.perf_counter()
+            expired = 0
+            now = 0
+            while len(timers):
+                now += step
+                expired += len(timers.expire(now))
+            finished = time.perf_counter()
+            report('{} {} timers'.format(name, count),
+                   insert_us = round((inserted - started) / count * 1e6, 3),
+                   cancel_us = round((cancelled - inserted) / len(handles[::10]) * 1e6, 3),
+                   expire_us = round((finished - cancelled) / expired * 1e6, 3))
+
+def dora_latency(count = 2000, port = 6830, clients = 5):
+    """Time from DHCPDISCOVER to DHCPACK seen by a client on loopback with zero
+    response delays, responses sent inline versus through the delay worker,
+    the server runs in a child process
+    """
+    import itertools
+    import os
+    import signal
+    import tempfile
+    from dhcp import AsyncioDHCPServer, DHCPServer, ReplySockets
+    configuration = reply_configuration()
+    configuration.dhcp_offer_after_seconds = configuration.dhcp_acknowledge_after_seconds = 0
+    configuration.client_rate_limit = None
+    host_file, configuration.host_file = tempfile.mkstemp(suffix = '.csv')
+    os.close(host_file)
+    client = socket(type = SOCK_DGRAM)
+    client.bind(('127.0.0.1', port + 1))
+    client.settimeout(1)
+    transaction_ids = itertools.count()
+
+    def exchange(transaction_id, mac, message_type, requested_ip_address = None):
+        client.sendto(client_packet(transaction_id, mac, message_type, requested_ip_address), ('127.0.0.1', port))
+        while True:
+            reply = LazyBootProtocolPacket(client.recv(4096))
+            if reply.transaction_id == transaction_id:
+                return reply
+
+    def dora(index):
+        mac = 0x020000000000 + index % clients
+        transaction_id = next(transaction_ids)
+        offer = exchange(transaction_id, mac, 'DHCPDISCOVER')
+        exchange(transaction_id, mac, 'DHCPREQUEST', offer.your_ip_address)
+
+    try:
+        for engine, server_class in (('threaded', DHCPServer), ('asyncio', AsyncioDHCPServer)):
+            for inline in (False, True):
+                configuration.inline_responses = inline
+
+                class LoopbackServer(server_class):
+                    def create_socket(self):
+                        server_socket = socket(type = SOCK_DGRAM)
+                        server_socket.bind(('127.0.0.1', port))
+                        return server_socket
+
+                    def create_reply_sockets(self):
+                        return ReplySockets(lambda: [], port = port + 2)
+
+                    def reply_destination(self, packet):
+                        return ('127.0.0.1', port + 1)
+
+                pid = os.fork()
+                if pid == 0:
+                    server = LoopbackServer(configuration)
+                    if engine == 'asyncio':
+                        server.loop.run_until_complete(server.serve_forever())
+                    else:
+                        server.run()
+                    os._exit(0)
+                try:
+                    time.sleep(0.5)
+                    for index in range(clients):
+                        dora(index)
+                    latencies = []
+                    for index in range(count):
+                        started = time.perf_counter()
+                        dora(index)
+                        latencies.append(time.perf_counter() - started)
+                finally:
+                    os.kill(pid, signal.SIGKILL)
+                    os.waitpid(pid, 0)
+                latencies.sort()
+                report('{} {}'.format(engine, 'inline' if inline else 'delay worker'),
+                       median_us = round(latencies[count // 2] * 1e6, 1),
+                       p99_us = round(latencies[count * 99 // 100] * 1e6, 1),
+                       dora_per_second = int(count / sum(latencies)))
+    finally:
+        client.close()
+        os.remove(configuration.host_file)
+
+benchmarks = [packet_memory, packet_parse, reply_serialize, batch_decode, reply_send, worker_throughput, delay_timers, dora_latency]
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or [benchmark.__name__ for benchmark in benchmarks]
+    for benchmark in benchmarks:
+        if benchmark.__name__ in names:
+            print('#', benchmark.__name__)
+            benchmark()
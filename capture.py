@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+"""Offline DHCP traffic: pcap / pcapng reader and writer and a replay engine
+
+Replay a capture through the DHCP server and record its replies:
+./capture.py capture.pcapng [replies.pcap] [dhcp.conf]
+"""
+
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+from dhcp import *
+
+# link layer types, see https://www.tcpdump.org/linktypes.html
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_LINUX_SLL2 = 276
+
+DHCP_PORTS = (67, 68)
+
+def udp_payload(frame, linktype, ports = DHCP_PORTS):
+    """Get (payload, (source ip, source port)) of UDP datagram in link layer frame
+    payload is a memoryview slice of frame, None is returned for other traffic
+    """
+    if len(frame) < 28:
+        return None
+    if linktype == LINKTYPE_ETHERNET:
+        index = 12
+        ethertype = frame[index] << 8 | frame[index + 1]
+        # skip 802.1Q / 802.1ad VLAN tags
+        while ethertype in (0x8100, 0x88a8) and len(frame) >= index + 6:
+            index += 4
+            ethertype = frame[index] << 8 | frame[index + 1]
+        if ethertype != 0x0800:
+            return None
+        index += 2
+    elif linktype == LINKTYPE_LINUX_SLL:
+        if frame[14] << 8 | frame[15] != 0x0800:
+            return None
+        index = 16
+    elif linktype == LINKTYPE_LINUX_SLL2:
+        if frame[0] << 8 | frame[1] != 0x0800:
+            return None
+        index = 20
+    elif linktype in (LINKTYPE_RAW, LINKTYPE_IPV4):
+        index = 0
+    elif linktype == LINKTYPE_NULL:
+        # address family in host byte order of the capturing machine
+        if 2 not in (frame[0], frame[3]):
+            return None
+        index = 4
+    else:
+        return None
+    if len(frame) < index + 28 or frame[index] >> 4 != 4:
+        return None
+    header_length = (frame[index] & 15) * 4
+    if frame[index + 9] != 17 or struct.unpack_from('>H', frame, index + 6)[0] & 0x3fff:
+        # not UDP or fragmented
+        return None
+    source = inet_ntoa(frame[index + 12:index + 16])
+    index += header_length
+    source_port, destination_port, length = struct.unpack_from('>HHH', frame, index)
+    if source_port not in ports and destination_port not in ports:
+        return None
+    return frame[index + 8:index + max(length, 8)], (source, source_port)
+
+class PcapReader(object):
+    """Streaming reader of pcap and pcapng files
+    Iterating yields (timestamp, payload, address) for every UDP datagram
+    to or from DHCP ports, payload is a memoryview ready for LazyBootProtocolPacket
+    """
+    def __init__(self, file):
+        """file is a path or a binary file object
+        """
+        self.file = open(file, 'rb') if isinstance(file, str) else file
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        magic = self.file.read(4)
+        if magic == b'\x0a\x0d\x0d\x0a':
+            records = self._pcapng_records(magic)
+        else:
+            records = self._pcap_records(magic)
+        for timestamp, frame, linktype in records:
+            datagram = udp_payload(memoryview(frame), linktype)
+            if datagram is not None:
+                yield (timestamp,) + datagram
+
+    def packets(self):
+        """Iterate over captured datagrams decoded as LazyBootProtocolPacket
+        """
+        for timestamp, payload, address in self:
+            if len(payload) >= 240:
+                yield LazyBootProtocolPacket(payload, address)
+
+    def _read(self, length):
+        data = self.file.read(length)
+        if len(data) < length:
+            raise EOFError()
+        return data
+
+    def _pcap_records(self, magic):
+        magics = {b'\xd4\xc3\xb2\xa1': ('<', 1e-6), b'\xa1\xb2\xc3\xd4': ('>', 1e-6),
+                  b'\x4d\x3c\xb2\xa1': ('<', 1e-9), b'\xa1\xb2\x3c\x4d': ('>', 1e-9)}
+        if magic not in magics:
+            raise ValueError('not a pcap or pcapng file')
+        endian, resolution = magics[magic]
+        linktype = struct.unpack(endian + 'I', self._read(20)[16:20])[0] & 0xffff
+        record = struct.Struct(endian + 'IIII')
+        while True:
+            header = self.file.read(record.size)
+            if len(header) < record.size:
+                return
+            seconds, fraction, captured_length, _ = record.unpack(header)
+            yield seconds + fraction * resolution, self._read(captured_length), linktype
+
+    def _pcapng_records(self, block_type):
+        endian = '<'
+        interfaces = [] # (linktype, timestamp resolution)
+        while True:
+            if block_type is None:
+                block_type = self.file.read(4)
+                if len(block_type) < 4:
+                    return
+            header = self._read(4)
+            if block_type == b'\x0a\x0d\x0d\x0a':
+                # section header block, defines byte order of the section
+                byte_order = self._read(4)
+                endian = '<' if byte_order == b'\x4d\x3c\x2b\x1a' else '>'
+                body = byte_order + self._read(struct.unpack(endian + 'I', header)[0] - 12)
+                interfaces = []
+            else:
+                body = memoryview(self._read(struct.unpack(endian + 'I', header)[0] - 8))
+            kind = struct.unpack(endian + 'I', block_type)[0]
+            block_type = None
+            if kind == 1:
+                # interface description block
+                linktype = struct.unpack_from(endian + 'H', body, 0)[0]
+                interfaces.append((linktype, self._timestamp_resolution(body, endian)))
+            elif kind == 6:
+                # enhanced packet block
+                interface, high, low, captured_length = struct.unpack_from(endian + 'IIII', body, 0)
+                linktype, resolution = interfaces[interface]
+                yield ((high << 32 | low) * resolution, body[20:20 + captured_length], linktype)
+            elif kind == 3:
+                # simple packet block, captured on the first interface
+                linktype, resolution = interfaces[0]
+                original_length = struct.unpack_from(endian + 'I', body, 0)[0]
+                yield None, body[4:4 + min(original_length, len(body) - 8)], linktype
+
+    @staticmethod
+    def _timestamp_resolution(body, endian):
+        """Read if_tsresol option of interface description block
+        """
+        index = 8
+        while index + 4 <= len(body) - 4:
+            code, length = struct.unpack_from(endian + 'HH', body, index)
+            if code == 0:
+                break
+            if code == 9 and length >= 1:
+                value = body[index + 4]
+                return 2.0 ** -(value & 127) if value & 128 else 10.0 ** -value
+            index += 4 + (length + 3) // 4 * 4
+        return 1e-6
+
+def ip_checksum(header):
+    """Internet checksum of IPv4 header
+    """
+    total = sum(struct.unpack('>{}H'.format(len(header) // 2), header))
+    while total >> 16:
+        total = (total & 0xffff) + (total >> 16)
+    return ~total & 0xffff
+
+class PcapWriter(object):
+    """Writer of pcap files with Ethernet framed UDP datagrams
+    """
+    def __init__(self, file):
+        """file is a path or a binary file object
+        """
+        self.file = open(file, 'wb') if isinstance(file, str) else file
+        self.lock = threading.Lock()
+        self.count = 0
+        self.file.write(struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, LINKTYPE_ETHERNET))
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, payload, source = ('0.0.0.0', 67), destination = ('255.255.255.255', 68),
+              timestamp = None, source_mac = b'\0' * 6, destination_mac = b'\xff' * 6):
+        """Write UDP datagram with payload sent from source to destination address
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        udp = struct.pack('>HHHH', source[1], destination[1], len(payload) + 8, 0) + bytes(payload)
+        ip = bytearray(struct.pack('>BBHHHBBH4s4s', 0x45, 0, 20 + len(udp), 0, 0, 64, 17, 0,
+                                   inet_aton(source[0]), inet_aton(destination[0])))
+        struct.pack_into('>H', ip, 10, ip_checksum(ip))
+        frame = destination_mac + source_mac + b'\x08\x00' + ip + udp
+        seconds = int(timestamp)
+        with self.lock:
+            self.file.write(struct.pack('<IIII', seconds, int((timestamp - seconds) * 1e6), len(frame), len(frame)))
+            self.file.write(frame)
+            self.count += 1
+
+class InlineDelayWorker(object):
+    """Delay worker calling functions immediately, response delays are ignored
+    """
+    def do_after(self, seconds, func, args = (), kw = {}):
+        timer = Timer(0, func, args, kw)
+        timer()
+        return timer
+
+    def close(self):
+        pass
+
+class ReplayDHCPServer(DHCPServer):
+    """DHCP server fed from captured packets without any network access
+    Responses are sent without delay, counted and written to a PcapWriter if one is given.
+    Packets are not rate limited, replay compresses the time between them.
+    """
+    def __init__(self, configuration, writer = None, server_identifier = '192.168.173.1'):
+        self.writer = writer
+        self.replay_server_identifier = server_identifier
+        self.replies = 0
+        super().__init__(configuration)
+
+    def create_socket(self):
+        return None
+
+    def create_delay_worker(self):
+        return InlineDelayWorker()
+
+    def create_rate_limiter(self):
+        return RateLimiter()
+
+    def create_watch_socket(self):
+        return None
+
+    def broadcast(self, packet, request = None):
+        packet.server_identifier = self.replay_server_identifier
+        data = packet.to_bytes()
+        self.replies += 1
+        if self.writer is not None:
+            destination = self.reply_destination(packet) or ('255.255.255.255', 68)
+            self.writer.write(data, (self.replay_server_identifier, 67), destination)
+
+def replay(server, packets):
+    """Feed client packets to server.received as fast as possible
+    Returns (number of packets, seconds spent)
+    """
+    count = 0
+    started = time.perf_counter()
+    for packet in packets:
+        if packet.message_type == 1:
+            server.received(packet)
+            count += 1
+    return count, time.perf_counter() - started
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('usage: capture.py capture.pcap [replies.pcap] [dhcp.conf]')
+        sys.exit(1)
+
+    configuration = DHCPServerConfiguration()
+    if len(sys.argv) > 3:
+        configuration.load(sys.argv[3])
+    # replay into a scratch host database
+    host_file, configuration.host_file = tempfile.mkstemp(suffix = '.csv')
+    os.close(host_file)
+
+    writer = PcapWriter(sys.argv[2]) if len(sys.argv) > 2 else None
+    server = ReplayDHCPServer(configuration, writer)
+    try:
+        with PcapReader(sys.argv[1]) as reader:
+            count, seconds = replay(server, reader.packets())
+    finally:
+        server.close()
+        if writer is not None:
+            writer.close()
+        os.remove(configuration.host_file)
+    print('{} packets in {:.3f}s: {:.0f} packets/s, {} replies'.format(
+        count, seconds, count / seconds if seconds else 0, server.replies))
@@ -1,5 +1,8 @@
 #!/usr/bin/env python3
 
+import asyncio
+import contextlib
+import os
 from os.path import exists
 import re
 from ttldict import  TTLOrderedDict
@@ -13,47 +16,104 @@ import traceback
 import random
 import socket
 import heapq    
+import signal
 import sys
 
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows, ARP entries and worker processes need it
+    fcntl = None
+else:
+    from leases import LeaseTable
+
 from listener import *
+from ratelimit import RateLimiter
+from admission import AdmissionQueue
+from timers import Timer, TimerHeap, TimingWheel
+
+try:
+    IP_PKTINFO
+except NameError:
+    # Linux value, not exported by the socket module of older Python versions
+    IP_PKTINFO = 8
 
 class TransactionDelayWorker(object):
     """Class used to delay response to DHCP client
     """
-    def __init__(self):
-        """class constructor internally using priority queue where priority is time
+    def __init__(self, timers = None, clock = time.monotonic):
+        """class constructor internally using a TimerHeap or TimingWheel of calls
+        by deadline of clock, the thread sleeps until the earliest one is due
         """
         self.closed = False
-        self.queue = PriorityQueue()
+        self.clock = clock
+        self.condition = threading.Condition()
+        self.timers = timers if timers is not None else TimerHeap()
+        self.wake_time = None # deadline the thread waits for, None if it waits for calls
         self.thread = threading.Thread(target = self._delay_response_thread)
         self.thread.start()
 
     def _delay_response_thread(self):
         """thread worker
         """
-        while not self.closed:
-            if self.closed:
-                break
-            if self.queue.qsize() > 0:
-                p = self.queue.get()
-                t, func, args, kw = p
-                now = time.time()
-                if now < t:
-                    time.sleep(0.01)
-                    self.queue.put(p)
-                else:
-                    func(*args, **kw)
-
+        while True:
+            with self.condition:
+                while not self.closed:
+                    expired = self.timers.expire(self.clock())
+                    if expired:
+                        break
+                    self.wake_time = self.timers.next_deadline()
+                    self.condition.wait(None if self.wake_time is None else self.wake_time - self.clock())
+                if self.closed:
+                    break
+            for timer in expired:
+                try:
+                    timer()
+                except:
+                    traceback.print_exc()
 
     def do_after(self, seconds, func, args = (), kw = {}):
         """Add to queue function which should be called after certain time
         specified by seconds, args, kw are arguments
+        Returns Timer, its cancel method drops the call
         """
-        self.queue.put((time.time() + seconds, func, args, kw))
+        deadline = self.clock() + seconds
+        with self.condition:
+            timer = self.timers.add(deadline, func, args, kw)
+            if self.wake_time is None or deadline < self.wake_time:
+                # earlier than the deadline the thread waits for
+                self.wake_time = deadline
+                self.condition.notify()
+        return timer
 
     def close(self):
         """Method used to stop worker
         """
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+class AsyncioDelayWorker(object):
+    """Delay worker scheduling responses as timers of an asyncio event loop
+    """
+    def __init__(self, loop):
+        self.closed = False
+        self.loop = loop
+
+    def _call(self, func, args, kw):
+        if not self.closed:
+            func(*args, **kw)
+
+    def do_after(self, seconds, func, args = (), kw = {}):
+        """Call function in event loop after certain time specified by seconds,
+        args, kw are arguments
+        Returns asyncio.TimerHandle, its cancel method drops the call
+        """
+        return self.loop.call_at(self.loop.time() + seconds, self._call, func, args, kw)
+
+    def close(self):
+        """Method used to stop worker, pending calls are dropped
+        """
         self.closed = True
 
 def get_host_ip_addresses():
@@ -61,6 +121,285 @@ def get_host_ip_addresses():
     """
     return gethostbyname_ex(gethostname())[2]
 
+# Linux ioctl adding an entry to the ARP table, see arp(7)
+SIOCSARP = 0x8955
+ATF_COM = 0x02
+ARPHRD_ETHER = 1
+
+def add_arp_entry(arp_socket, ip, mac):
+    """Tell the kernel that integer address ip belongs to integer mac address
+    so a client without configured address can be reached by unicast.
+    Returns False if this is not possible (not Linux, not root, no route)
+    """
+    if fcntl is None:
+        return False
+    request = struct.pack('=H2s4s8sH6s8si16s16s',
+                          AF_INET, b'', ip.to_bytes(4, 'big'), b'', # arp_pa
+                          ARPHRD_ETHER, mac.to_bytes(6, 'big'), b'', # arp_ha
+                          ATF_COM, b'', b'') # arp_flags, arp_netmask, arp_dev
+    try:
+        fcntl.ioctl(arp_socket.fileno(), SIOCSARP, request)
+    except OSError:
+        return False
+    return True
+
+# struct in_pktinfo {int ipi_ifindex; in_addr ipi_spec_dst; in_addr ipi_addr;}
+in_pktinfo = struct.Struct('=i4s4s')
+
+def enable_packet_info(server_socket):
+    """Ask socket to report interface and addresses of received datagrams,
+    False if the platform does not support it
+    """
+    if not hasattr(server_socket, 'recvmsg'):
+        return False
+    try:
+        server_socket.setsockopt(IPPROTO_IP, IP_PKTINFO, 1)
+    except OSError:
+        return False
+    return True
+
+def receive_datagram(server_socket):
+    """Receive datagram on socket with packet info enabled
+    Returns (data, address, ingress, destination), ingress is (interface index,
+    integer local address), destination the integer address the datagram was
+    sent to, both are None if the socket did not report them
+    """
+    data, ancillary, flags, address = server_socket.recvmsg(4096, CMSG_SPACE(in_pktinfo.size))
+    for level, kind, value in ancillary:
+        if level == IPPROTO_IP and kind == IP_PKTINFO:
+            ifindex, local_address, destination = in_pktinfo.unpack_from(value)
+            return data, address, (ifindex, int.from_bytes(local_address, 'big')), int.from_bytes(destination, 'big')
+    return data, address, None, None
+
+class ReplySockets(object):
+    """Broadcast sockets bound to the DHCP server port of every server address
+    Sockets are opened once and reused for all replies. Server addresses are
+    looked up again at most every refresh_interval seconds and sockets are only
+    opened or closed for addresses that appeared or disappeared. Local
+    addresses packets were received on are added to the looked up ones.
+    """
+    def __init__(self, get_addresses = get_host_ip_addresses, port = 67, refresh_interval = 10, changed = None,
+                 reuse_port = False):
+        """changed(opened, closed) is called with lists of sockets when the
+        address set changes, before the closed sockets are closed.
+        reuse_port lets worker processes bind the same addresses
+        """
+        self.get_addresses = get_addresses
+        self.port = port
+        self.reuse_port = reuse_port
+        self.refresh_interval = refresh_interval
+        self.changed = changed
+        self.lock = threading.Lock()
+        self.by_address = {} # address: socket
+        # socket bound to all addresses sending replies when no address socket is open
+        self.fallback = None
+        self.learned = [] # local addresses packets arrived on
+        self.next_refresh = 0
+        # instrumentation
+        self.lookups = 0
+        self.sockets_opened = 0
+        self.sockets_closed = 0
+        self.replies = 0
+        self.datagrams = 0
+        self.datagrams_saved = 0 # compared to broadcast and unicast to self from every address
+        self.relayed = 0
+        self.unicast = 0
+        self.broadcast = 0
+        self.fallbacks = 0
+        self.dropped = 0
+        self.send_seconds = 0.0
+
+    def open(self, address):
+        """Open broadcast socket bound to address, None if address can not be bound
+        """
+        reply_socket = socket(type = SOCK_DGRAM)
+        try:
+            reply_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+            reply_socket.setsockopt(SOL_SOCKET, SO_BROADCAST, 1)
+            if self.reuse_port:
+                reply_socket.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+            reply_socket.bind((address, self.port))
+        except OSError:
+            reply_socket.close()
+            return None
+        enable_packet_info(reply_socket)
+        self.sockets_opened += 1
+        return reply_socket
+
+    def refresh(self, force = False):
+        """Look up server addresses if refresh_interval passed and update sockets
+        """
+        now = time.monotonic()
+        if not force and now < self.next_refresh:
+            return
+        with self.lock:
+            self.next_refresh = now + self.refresh_interval
+            self.lookups += 1
+            addresses = self.get_addresses()
+            addresses += [address for address in self.learned if address not in addresses]
+            if list(self.by_address) == addresses:
+                return
+            by_address = {}
+            opened = []
+            for address in addresses:
+                reply_socket = self.by_address.get(address) or self.open(address)
+                if reply_socket is not None:
+                    by_address[address] = reply_socket
+                    if address not in self.by_address:
+                        opened.append(reply_socket)
+            closed = [reply_socket for address, reply_socket in self.by_address.items() if address not in by_address]
+            self.by_address = by_address
+            if self.changed is not None and (opened or closed):
+                self.changed(opened, closed)
+            for reply_socket in closed:
+                reply_socket.close()
+                self.sockets_closed += 1
+
+    def learn(self, address):
+        """Get socket bound to local address, opened if packets arrived on an
+        address which was not looked up. None if it can not be bound
+        """
+        reply_socket = self.by_address.get(address)
+        if reply_socket is not None:
+            return reply_socket
+        with self.lock:
+            if address not in self.learned:
+                self.learned.append(address)
+            reply_socket = self.open(address)
+            if reply_socket is None:
+                return None
+            # readers iterate over by_address without the lock
+            self.by_address = dict(self.by_address)
+            self.by_address[address] = reply_socket
+            if self.changed is not None:
+                self.changed([reply_socket], [])
+            return reply_socket
+
+    @property
+    def addresses(self):
+        self.refresh()
+        return list(self.by_address)
+
+    def sockets(self):
+        """Get currently open sockets, clients unicast to them as well
+        """
+        return list(self.by_address.values())
+
+    def send(self, packet, client_port = 68, ingress = None):
+        """Broadcast packet to clients on the interface of ingress, the
+        (interface index, local address) the request arrived on, or from
+        every server address if it is not known
+        Returns False if there is no socket to send it from
+        """
+        started = time.perf_counter()
+        self.refresh()
+        sockets = list(self.by_address.items())
+        if ingress is not None:
+            address = int_to_ip(ingress[1])
+            reply_socket = self.learn(address)
+            if reply_socket is not None:
+                sockets = [(address, reply_socket)]
+        for address, reply_socket in sockets:
+            packet.server_identifier = address
+            self.sendto(reply_socket, packet.to_bytes(), ('255.255.255.255', client_port), address, ingress)
+        self.broadcast += 1
+        if not sockets:
+            return self._send_fallback(packet, ('255.255.255.255', client_port), ingress, started)
+        self._sent(len(sockets), started)
+        return True
+
+    def send_to(self, packet, destination, address = None, ingress = None):
+        """Send packet to destination (host, port) from server address,
+        the first server address is used if address is None
+        Returns False if there is no socket to send it from
+        """
+        started = time.perf_counter()
+        self.refresh()
+        if address is not None:
+            self.learn(address)
+        if address not in self.by_address:
+            address = next(iter(self.by_address), None)
+        if destination[1] == 67:
+            self.relayed += 1
+        else:
+            self.unicast += 1
+        if address is None:
+            return self._send_fallback(packet, destination, ingress, started)
+        packet.server_identifier = address
+        self.sendto(self.by_address[address], packet.to_bytes(), destination, address, ingress)
+        self._sent(1, started)
+        return True
+
+    def _send_fallback(self, packet, destination, ingress, started):
+        """Send packet from the fallback socket, False if there is none
+        """
+        if self.fallback is None:
+            self.dropped += 1
+            self._sent(0, started)
+            return False
+        address = '0.0.0.0'
+        if ingress is not None:
+            address = packet.server_identifier = int_to_ip(ingress[1])
+        try:
+            self.fallback.setsockopt(SOL_SOCKET, SO_BROADCAST, 1)
+            self.sendto(self.fallback, packet.to_bytes(), destination, address, ingress)
+        except OSError:
+            self.dropped += 1
+            self._sent(0, started)
+            return False
+        self.fallbacks += 1
+        self._sent(1, started)
+        return True
+
+    @staticmethod
+    def sendto(reply_socket, data, destination, address, ingress = None):
+        """Send data from address leaving through the interface of ingress if it is known
+        """
+        if ingress is None:
+            reply_socket.sendto(data, destination)
+        else:
+            # a zero source address would replace the one the socket is bound to
+            packet_info = in_pktinfo.pack(ingress[0], inet_aton(address), bytes(4))
+            reply_socket.sendmsg([data], [(IPPROTO_IP, IP_PKTINFO, packet_info)], 0, destination)
+
+    def _sent(self, datagrams, started):
+        self.replies += 1
+        self.datagrams += datagrams
+        self.datagrams_saved += 2 * len(self.by_address) - datagrams
+        self.send_seconds += time.perf_counter() - started
+
+    def add_arp_entry(self, ip, mac):
+        """Make client reachable by unicast before it configured its address
+        """
+        reply_socket = next(iter(self.by_address.values()), None)
+        return reply_socket is not None and add_arp_entry(reply_socket, ip, mac)
+
+    def close(self):
+        with self.lock:
+            if self.changed is not None and self.by_address:
+                self.changed([], list(self.by_address.values()))
+            for reply_socket in self.by_address.values():
+                reply_socket.close()
+                self.sockets_closed += 1
+            self.by_address = {}
+
+    def statistics(self):
+        """Get counters of reply sending
+        """
+        return {'reply_sockets': len(self.by_address),
+                'reply_address_lookups': self.lookups,
+                'reply_sockets_opened': self.sockets_opened,
+                'reply_sockets_closed': self.sockets_closed,
+                'replies_sent': self.replies,
+                'reply_datagrams_sent': self.datagrams,
+                'reply_datagrams_saved': self.datagrams_saved,
+                'replies_relayed': self.relayed,
+                'replies_unicast': self.unicast,
+                'replies_broadcast': self.broadcast,
+                'replies_fallback': self.fallbacks,
+                'replies_dropped': self.dropped,
+                'reply_send_us': round(self.send_seconds / self.replies * 1e6, 2) if self.replies else 0.0}
+
 class PriorityQueue(object):
     """This class contains Heapq for more information:
     https://docs.python.org/3/library/heapq.html
@@ -79,6 +418,28 @@ class PriorityQueue(object):
     def qsize(self):
         return len(self._queue)
 
+def encode_option(option, value):
+    """Encode option value using the option codec table, bytes are kept as they are
+    """
+    function = option_codecs[option][2]
+    if function:
+        value = function(value)
+    return bytes(value)
+
+def resolve_options(configuration):
+    """Get option number -> encoded value for all options set in configuration,
+    options set by name take precedence over options set as option_N
+    """
+    resolved = dict()
+    names = ['option_{}'.format(option) for option in range(256)]
+    names += [name for name in option_codes if not name.startswith('option_')]
+    for name in names:
+        value = getattr(configuration, name, None)
+        if value is not None:
+            for option in option_codes[name]:
+                resolved[option] = encode_option(option, value)
+    return resolved
+
 class WriteBootProtocolPacket(object):
     """DHCP protocol datagram serializer
     This class serializes UDP DHCP packet, instance is constructed using global 
@@ -92,97 +453,159 @@ class WriteBootProtocolPacket(object):
     transaction_id = None
 
     seconds_elapsed = 0
-    bootp_flags = 0 # unicast
+    bootp_flags = 0 # unicast, BROADCAST_FLAG for broadcast
 
-    client_ip_address = '0.0.0.0'
-    your_ip_address = '0.0.0.0'
-    next_server_ip_address = '0.0.0.0'
-    relay_agent_ip_address = '0.0.0.0'
+    # addresses as integers, the *_address properties below convert strings
+    ciaddr = 0
+    yiaddr = 0
+    siaddr = 0
+    giaddr = 0
 
-    client_mac_address = None
+    chaddr = None
     magic_cookie = '99.130.83.99'
 
     parameter_order = []
+
+    # size of the largest IP datagram the client accepts, see maximum_dhcp_message_size
+    maximum_message_size = 576
     
+    header = struct.Struct('>BBBBIHHIIII')
+
+    template_cache = None # ReplyTemplateCache shared by all packets, set below
+
     def __init__(self, configuration):
-        """Create new packet instance and search for options set in configuration 
-        and copy them tgo packet
+        """Create new packet instance with options resolved from configuration,
+        options set on the packet afterwards override them
         """
-        for i in range(256):
-            names = ['option_{}'.format(i)]
-            if i < len(options) and hasattr(configuration, options[i][0]):
-                names.append(options[i][0])
-            for name in names:
-                if hasattr(configuration, name):
-                    setattr(self, name, getattr(configuration, name))
+        self.configuration_options = configuration.resolved_options()
+        self.packet_options = dict() # option: encoded value or None if removed
 
-    def to_bytes(self):
-        """Serialize UDP DHCP response packet to bytes
+    def __setattr__(self, name, value):
+        """Store options by number encoded, other attributes as usual
         """
-        result = bytearray(236)
-        
-        result[0] = self.message_type
-        result[1] = self.hardware_type
-        result[2] = self.hardware_address_length
-        result[3] = self.hops
-
-        result[4:8] = struct.pack('>I', self.transaction_id)
-
-        result[ 8:10] = shortpack(self.seconds_elapsed)
-        result[10:12] = shortpack(self.bootp_flags)
+        codes = option_codes.get(name)
+        if codes is None:
+            super().__setattr__(name, value)
+            return
+        for option in codes:
+            self.packet_options[option] = None if value is None else encode_option(option, value)
 
-        result[12:16] = inet_aton(self.client_ip_address)
-        result[16:20] = inet_aton(self.your_ip_address)
-        result[20:24] = inet_aton(self.next_server_ip_address)
-        result[24:28] = inet_aton(self.relay_agent_ip_address)
+    def __getattr__(self, name):
+        """Get value of option set on the packet or in the configuration
+        decoded like it was set, get_option returns it encoded
+        """
+        codes = option_codes.get(name)
+        if codes is None:
+            raise AttributeError(name)
+        # with duplicate option names the last option present wins
+        for option in reversed(codes):
+            value = self.get_option(option)
+            if value is not None:
+                function = option_codecs[option][1] if option_codecs[option][0] == name else None
+                return function(value) if function else value
+        if any(option in self.packet_options for option in codes):
+            # removed from the packet
+            return None
+        raise AttributeError(name)
 
-        result[28:28 + self.hardware_address_length] = macpack(self.client_mac_address)
-        
-        result += inet_aton(self.magic_cookie)
+    def to_bytes(self):
+        """Serialize UDP DHCP response packet to bytes
+        Options are copied from a cached template of this packet layout,
+        only the header and the options set on the packet are written
+        """
+        template, offsets = self.template_cache.get(self.template_key(), self.build_template)
+        result = bytearray(template)
+        self.header.pack_into(result, 0,
+                              self.message_type, self.hardware_type, self.hardware_address_length, self.hops,
+                              self.transaction_id, self.seconds_elapsed, self.bootp_flags,
+                              self.ciaddr, self.yiaddr, self.siaddr, self.giaddr)
+        result[28:28 + self.hardware_address_length] = macpack(self.chaddr)
+        result[236:240] = inet_aton(self.magic_cookie)
+        for option, offset in offsets:
+            value = self.packet_options[option]
+            result[offset:offset + len(value)] = value
+        return bytes(result)
 
-        for option in self.options:
-            value = self.get_option(option)
-            #print(option, value)
-            if value is None:
-                continue
-            result += bytes([option, len(value)]) + value
+    def template_key(self):
+        """Get key identifying layout of the packet: configuration options,
+        requested order, size limit and lengths of options set on the packet
+        """
+        return (id(self.configuration_options),
+                tuple(self.parameter_order or ()),
+                self.maximum_message_size,
+                tuple(sorted((option, None if value is None else len(value))
+                             for option, value in self.packet_options.items())))
+
+    def build_template(self):
+        """Serialize options of the packet after an empty header
+        returning bytes and offsets of option values set on the packet
+        """
+        result = bytearray(240)
+        offsets = []
+        options = [(option, self.get_option(option)) for option in self.options]
+        # DHCP message must fit into IP datagram of maximum_message_size
+        limit = max(self.maximum_message_size, 576) - 28
+        if 240 + sum(2 + len(value) for option, value in options) + 1 > limit:
+            return self.build_overloaded_template(options, limit)
+        for option, value in options:
+            result += bytes([option, len(value)])
+            if option in self.packet_options:
+                offsets.append((option, len(result)))
+            result += value
         result += bytes([255])
-        return bytes(result)
+        # keep configuration options alive so their id stays unique in the key
+        return bytes(result), tuple(offsets), self.configuration_options
+
+    def build_overloaded_template(self, options, limit):
+        """Serialize options which do not fit into the options field spilling
+        them into file and sname fields, see option_overload in RFC 2132 9.3
+        """
+        # [start of field, capacity without end option, serialized options]
+        fields = [[240 + 3, limit - 240 - 3 - 1, bytearray()],
+                  [FILE_FIELD[0], FILE_FIELD[1] - FILE_FIELD[0] - 1, bytearray()],
+                  [SNAME_FIELD[0], SNAME_FIELD[1] - SNAME_FIELD[0] - 1, bytearray()]]
+        offsets = []
+        # dhcp_message_type first so that it stays in the options field,
+        # options which do not fit into any field are left out
+        for option, value in sorted(options, key = lambda option: option[0] != 53):
+            for start, capacity, data in fields:
+                if len(data) + 2 + len(value) <= capacity:
+                    data += bytes([option, len(value)])
+                    if option in self.packet_options:
+                        offsets.append((option, start + len(data)))
+                    data += value
+                    break
+        overload = (OVERLOAD_FILE if fields[1][2] else 0) | (OVERLOAD_SNAME if fields[2][2] else 0)
+        result = bytearray(240)
+        for start, capacity, data in fields[1:]:
+            if data:
+                result[start:start + len(data) + 1] = data + bytes([255])
+        result += bytes([52, 1, overload]) + fields[0][2] + bytes([255])
+        return bytes(result), tuple(offsets), self.configuration_options
 
     def get_option(self, option):
-        """Get DHCP UDP response packet option value
+        """Get DHCP UDP response packet encoded option value
         """
-        if option < len(options) and hasattr(self, options[option][0]):
-            value = getattr(self, options[option][0])
-        elif hasattr(self, 'option_{}'.format(option)):
-            value = getattr(self, 'option_{}'.format(option))
-        else:
-            return None
-        function = options[option][2]
-        if function and value is not None:
-            value = function(value)
-        return value
+        if option in self.packet_options:
+            return self.packet_options[option]
+        return self.configuration_options.get(option)
     
     @property
     def options(self):
-        """Get DHCP UDP response packet option value
+        """Get numbers of options present in the packet, requested ones first
         """
-        done = list()
+        present = set(self.configuration_options)
+        for option, value in self.packet_options.items():
+            if value is None:
+                present.discard(option)
+            else:
+                present.add(option)
         # fulfill wishes
-        for option in self.parameter_order:
-            if option < len(options) and hasattr(self, options[option][0]) or hasattr(self, 'option_{}'.format(option)):
-                # this may break with the specification because we must try to fulfill the wishes
-                if option not in done:
-                    done.append(option)
+        # this may break with the specification because we must try to fulfill the wishes
+        done = list(dict.fromkeys(option for option in self.parameter_order or () if option in present))
         # add my stuff
-        for option, o in enumerate(options):
-            if o[0] and hasattr(self, o[0]):
-                if option not in done:
-                    done.append(option)
-        for option in range(256):
-            if hasattr(self, 'option_{}'.format(option)):
-                if option not in done:
-                    done.append(option)
+        requested = set(done)
+        done.extend(option for option in sorted(present) if option not in requested)
         return done
 
     def __str__(self):
@@ -190,39 +613,163 @@ class WriteBootProtocolPacket(object):
         """
         return str(ReadBootProtocolPacket(self.to_bytes()))
 
+def _address_property(name, to_string, from_string):
+    return property(lambda self: to_string(getattr(self, name)),
+                    lambda self, value: setattr(self, name, from_string(value)))
+
+WriteBootProtocolPacket.client_ip_address = _address_property('ciaddr', int_to_ip, ip_to_int)
+WriteBootProtocolPacket.your_ip_address = _address_property('yiaddr', int_to_ip, ip_to_int)
+WriteBootProtocolPacket.next_server_ip_address = _address_property('siaddr', int_to_ip, ip_to_int)
+WriteBootProtocolPacket.relay_agent_ip_address = _address_property('giaddr', int_to_ip, ip_to_int)
+WriteBootProtocolPacket.client_mac_address = _address_property('chaddr', int_to_mac, mac_to_int)
+
+class ReplyTemplateCache(object):
+    """Least recently used cache of serialized reply templates
+    """
+    def __init__(self, size):
+        self.size = size
+        self.templates = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, build):
+        """Get template for key, build and store it if it is not cached
+        """
+        with self.lock:
+            template = self.templates.get(key)
+            if template is not None:
+                self.hits += 1
+                self.templates.move_to_end(key)
+                return template[:2]
+            self.misses += 1
+        template = build()
+        with self.lock:
+            self.templates[key] = template
+            while len(self.templates) > self.size:
+                self.templates.popitem(last = False)
+        return template[:2]
+
+    def clear(self):
+        """Forget templates and counters
+        """
+        with self.lock:
+            self.templates.clear()
+            self.hits = 0
+            self.misses = 0
+
+    @property
+    def hit_rate(self):
+        """Get fraction of lookups served from cache
+        """
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def statistics(self):
+        return {'reply_templates': len(self.templates),
+                'reply_template_hits': self.hits,
+                'reply_template_misses': self.misses,
+                'reply_template_hit_rate': round(self.hit_rate, 4)}
+
+WriteBootProtocolPacket.template_cache = ReplyTemplateCache(256)
+
 class DHCPTransaction(object):
     """Class representing DHCP Transaction
     """
-    def __init__(self, server):
+    __slots__ = ('server', 'configuration', 'transaction_id', 'done_time', 'done', 'timers', 'pending', 'reply', 'retransmitted')
+
+    def __init__(self, server, transaction_id = None):
         """Contructor of new transaction
         """
         self.server = server
         self.configuration = server.configuration
-        self.packets = []
-        self.done_time = time.time() + self.configuration.length_of_transaction
+        self.transaction_id = transaction_id
+        self.done_time = server.clock.time() + self.configuration.length_of_transaction
         self.done = False
-        self.do_after = self.server.delay_worker.do_after
+        self.timers = [] # handles of delayed calls, cancelled on close
+        self.pending = None # key of the request a response is scheduled for
+        self.reply = None # (key of request, reply packet) sent last
+        self.retransmitted = False # the client sent the pending request again
         #self.debug = debug
         
     def is_done(self):
         """Check if transaction is done 
         """
-        return self.done or self.done_time < time.time()
+        return self.done or self.done_time < self.server.clock.time()
 
     def close(self):
-        """Close transaction
+        """Close transaction, it is removed from the server by the next sweep
         """
+        if self.done:
+            return
         self.done = True
+        for timer in self.timers:
+            timer.cancel()
+        self.timers = []
+        self.done_time = min(self.done_time, self.server.clock.time())
+        self.server.transactions.expire_at(self.done_time, self)
+
+    def do_after(self, seconds, func, args = ()):
+        """Call method after seconds unless the transaction is closed before,
+        at once without a delay. Nothing is scheduled on a closed transaction
+        """
+        if self.done:
+            return
+        if seconds <= 0 and self.configuration.inline_responses:
+            func(*args)
+        else:
+            self.timers.append(self.server.delay_worker.do_after(seconds, func, args))
+
+    @staticmethod
+    def request_key(packet):
+        """Get key telling retransmissions of a request apart from other requests,
+        they differ from the first one only in the seconds elapsed field.
+        Computed once per packet
+        """
+        return packet.decode_field('request_key', lambda name: hash(bytes(packet.data[10:])))
+
+    def duplicate(self, packet):
+        """Check if packet retransmits a request which is answered already or
+        about to be, the reply sent is sent again without choosing an address
+        """
+        key = self.request_key(packet)
+        if key == self.pending:
+            self.server.transactions.coalesced += 1
+            self.retransmitted = True
+            return True
+        if self.reply is not None and self.reply[0] == key:
+            self.configuration.debug_packet('sending again', self.reply[1])
+            self.server.transactions.resent += 1
+            self.server.broadcast(self.reply[1], packet)
+            return True
+        return False
+
+    def answered(self, request, reply):
+        """Remember reply sent to request for its retransmissions
+        """
+        self.reply = (self.request_key(request), reply)
 
     def receive(self, packet):
         """Receive DHCP UDP packet check it's type and call a proper callback
         """
         # packet from client <-> packet.message_type == 1
+        if packet.message_type == 1 and packet.dhcp_message_type == 'DHCPREQUEST' and self.server.chose_other_server(packet):
+            # the client is served by the server it chose
+            if not self.done:
+                self.server.other_servers.transactions_closed += 1
+            self.reply = None
+            self.close()
+            return True
+        if packet.message_type == 1 and packet.dhcp_message_type in ('DHCPDISCOVER', 'DHCPREQUEST'):
+            if self.duplicate(packet):
+                return True
+            self.pending = self.request_key(packet)
+            self.retransmitted = False
         if packet.message_type == 1 and packet.dhcp_message_type == 'DHCPDISCOVER':
-            self.do_after(self.configuration.dhcp_offer_after_seconds,
+            self.do_after(self.server.response_delay(packet, self.configuration.dhcp_offer_after_seconds),
                           self.received_dhcp_discover, (packet,), )
         elif packet.message_type == 1 and packet.dhcp_message_type == 'DHCPREQUEST':
-            self.do_after(self.configuration.dhcp_acknowledge_after_seconds,
+            self.do_after(self.server.response_delay(packet, self.configuration.dhcp_acknowledge_after_seconds),
                           self.received_dhcp_request, (packet,), )
         elif packet.message_type == 1 and packet.dhcp_message_type == 'DHCPINFORM':
             self.received_dhcp_inform(packet)
@@ -233,8 +780,11 @@ class DHCPTransaction(object):
     def received_dhcp_discover(self, discovery):
         """Method used to handle DHCP Discover packet
         """
+        if self.pending == self.request_key(discovery):
+            self.pending = None
         if self.is_done(): return
-        self.configuration.debug('discover:\n {}'.format(str(discovery).replace('\n', '\n\t')))
+        self.configuration.debug_packet('discover', discovery)
+        self.server.unanswered(discovery, self.retransmitted)
         self.send_offer(discovery)
 
     def send_offer(self, discovery):
@@ -243,25 +793,33 @@ class DHCPTransaction(object):
         # https://tools.ietf.org/html/rfc2131
         offer = WriteBootProtocolPacket(self.configuration)
         offer.parameter_order = discovery.parameter_request_list
-        mac = discovery.client_mac_address
-        ip = offer.your_ip_address = self.server.get_ip_address(discovery)
+        mac = discovery.chaddr
+        ip = offer.yiaddr = self.server.get_ip_address(discovery)
+        if ip is None:
+            # no address left
+            return
         # offer.client_ip_address = 
         offer.transaction_id = discovery.transaction_id
         # offer.next_server_ip_address =
-        offer.relay_agent_ip_address = discovery.relay_agent_ip_address
-        offer.client_mac_address = mac
-        offer.client_ip_address = discovery.client_ip_address or '0.0.0.0'
+        offer.giaddr = discovery.giaddr
+        offer.chaddr = mac
+        offer.ciaddr = discovery.ciaddr
+        offer.maximum_message_size = discovery.maximum_dhcp_message_size or 576
         offer.bootp_flags = discovery.bootp_flags
         offer.dhcp_message_type = 'DHCPOFFER'
         offer.client_identifier = mac
-        self.configuration.debug('offer:\n {}'.format(str(offer).replace('\n', '\n\t')))
-        self.server.broadcast(offer)
+        self.configuration.debug_packet('offer', offer)
+        self.server.broadcast(offer, discovery)
+        self.answered(discovery, offer)
     
     def received_dhcp_request(self, request):
         """Method used to handle DHCP Request packet
         """
+        if self.pending == self.request_key(request):
+            self.pending = None
         if self.is_done(): return 
-        self.configuration.debug('request:\n {}'.format(str(request).replace('\n', '\n\t')))
+        self.configuration.debug_packet('request', request)
+        self.server.unanswered(request, self.retransmitted)
         self.server.client_has_chosen(request)
         self.acknowledge(request)
         self.close()
@@ -274,23 +832,138 @@ class DHCPTransaction(object):
         ack.transaction_id = request.transaction_id
         # ack.next_server_ip_address =
         ack.bootp_flags = request.bootp_flags
-        ack.relay_agent_ip_address = request.relay_agent_ip_address
-        mac = request.client_mac_address
-        ack.client_mac_address = mac
-        requested_ip_address = request.requested_ip_address
-        ack.client_ip_address = request.client_ip_address or '0.0.0.0'
-        ack.your_ip_address = self.server.get_ip_address(request)
+        ack.giaddr = request.giaddr
+        ack.chaddr = request.chaddr
+        ack.ciaddr = request.ciaddr
+        ack.yiaddr = self.server.get_ip_address(request)
+        if ack.yiaddr is None:
+            return
+        ack.maximum_message_size = request.maximum_dhcp_message_size or 576
         ack.dhcp_message_type = 'DHCPACK'
-        self.configuration.debug('acknowledge:\n {}'.format(str(ack).replace('\n', '\n\t')))
-        self.server.broadcast(ack)
+        self.configuration.debug_packet('acknowledge', ack)
+        self.server.broadcast(ack, request)
+        self.answered(request, ack)
 
     def received_dhcp_inform(self, inform):
         """Method used to handle DHCP Inform packet
         """
-        self.configuration.debug('inform:\n {}'.format(str(inform).replace('\n', '\n\t')))
+        self.configuration.debug_packet('inform', inform)
         self.close()
         self.server.client_has_chosen(inform)
 
+class TransactionTable(dict):
+    """Transactions by id, created on first access
+    Expiry times are kept in a heap so a sweep only touches expired transactions.
+    At most capacity transactions are kept, a new one evicts the transaction
+    done first, closed ones before those still open and of these the oldest.
+    """
+    def __init__(self, server, capacity = 65536):
+        self.server = server
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.expiry = [] # (done_time, sequence, transaction)
+        self.sequence = 0
+        self.created = 0
+        self.evicted = 0
+        # retransmitted requests
+        self.coalesced = 0 # while their response was scheduled
+        self.resent = 0 # answered with the reply sent before
+
+    def __missing__(self, transaction_id):
+        transaction = DHCPTransaction(self.server, transaction_id)
+        evicted = []
+        with self.lock:
+            while len(self) >= self.capacity and self.expiry:
+                done_time, sequence, oldest = heapq.heappop(self.expiry)
+                if self.get(oldest.transaction_id) is oldest:
+                    del self[oldest.transaction_id]
+                    evicted.append(oldest)
+            self[transaction_id] = transaction
+            self.created += 1
+            self.evicted += len(evicted)
+            self.sequence += 1
+            heapq.heappush(self.expiry, (transaction.done_time, self.sequence, transaction))
+        for oldest in evicted:
+            # drops its pending responses
+            oldest.close()
+        return transaction
+
+    def expire_at(self, done_time, transaction):
+        """Remove transaction in the first sweep after done_time, entries of
+        transactions closed earlier are skipped when they come up
+        """
+        with self.lock:
+            if self.get(transaction.transaction_id) is not transaction:
+                # already removed
+                return
+            self.sequence += 1
+            heapq.heappush(self.expiry, (done_time, self.sequence, transaction))
+
+    def remove_expired(self, now = None):
+        """Close and remove transactions which are done, returns their number
+        """
+        if now is None:
+            now = self.server.clock.time()
+        expired = []
+        with self.lock:
+            while self.expiry and self.expiry[0][0] < now:
+                done_time, sequence, transaction = heapq.heappop(self.expiry)
+                if self.get(transaction.transaction_id) is transaction:
+                    del self[transaction.transaction_id]
+                    expired.append(transaction)
+        for transaction in expired:
+            transaction.close()
+        return len(expired)
+
+    def statistics(self):
+        return {'transactions': len(self),
+                'transaction_capacity': self.capacity,
+                'transaction_occupancy': round(len(self) / self.capacity, 4),
+                'transactions_created': self.created,
+                'transactions_evicted': self.evicted,
+                'retransmissions_coalesced': self.coalesced,
+                'replies_resent': self.resent}
+
+class OtherServers(object):
+    """Liveness of other DHCP servers per network segment, learned from their
+    replies seen on the client port
+    """
+    # requests left to this server in a row until the others count as down
+    misses_until_down = 3
+
+    def __init__(self):
+        self.misses = {} # segment: requests no other server answered since one did
+        self.replies_seen = 0
+        self.requests_for_others = 0 # requests selecting another server
+        self.transactions_closed = 0
+
+    def answered(self, segment):
+        self.misses[segment] = 0
+        self.replies_seen += 1
+
+    def chosen(self, segment):
+        self.misses[segment] = 0
+        self.requests_for_others += 1
+
+    def missed(self, segment):
+        self.misses[segment] = self.misses.get(segment, 0) + 1
+
+    def alive(self, segment):
+        """Check if another server answers on segment, assumed until it missed requests
+        """
+        return self.misses.get(segment, 0) < self.misses_until_down
+
+    def statistics(self):
+        return {'other_server_replies_seen': self.replies_seen,
+                'other_server_requests': self.requests_for_others,
+                'other_server_transactions_closed': self.transactions_closed,
+                'segments_without_other_server': sum(not self.alive(segment) for segment in list(self.misses))}
+
+def interface_indexes(configuration):
+    """Get set of indexes of the network interfaces named in configuration.interfaces
+    """
+    return {index for index, name in if_nameindex() if name in configuration.interfaces}
+
 class DHCPServerConfiguration(object):
     """Class to load DHCP server configuration from file or command line
     """
@@ -298,6 +971,13 @@ class DHCPServerConfiguration(object):
     dhcp_acknowledge_after_seconds = 10
     length_of_transaction = 40
 
+    # watch replies of other DHCP servers on the client port, a delayed
+    # response to a client another server answered is dropped, on segments
+    # where the other servers stopped answering competitive_minimum_delay
+    # is used instead of the delays above
+    competitive_delay = False
+    competitive_minimum_delay = 0
+
     network = '192.168.173.0'
     broadcast_address = '255.255.255.255'
     subnet_mask = '255.255.255.0'
@@ -308,8 +988,68 @@ class DHCPServerConfiguration(object):
 
     host_file = 'hosts.csv'
 
+    # names of network interfaces served, None for all
+    interfaces = None
+
+    # packets per second and burst accepted from one client and from all
+    # clients together, packets over the limit are dropped, None for no limit
+    client_rate_limit = 2
+    client_rate_burst = 10
+    global_rate_limit = None
+    global_rate_burst = 1000
+
+    # transactions kept at most, when a packet starts one more the one done
+    # first is dropped together with its pending response
+    max_transactions = 65536
+
+    # packets waiting to be handled, renewals are served first and
+    # DHCPDISCOVER and DHCPINFORM are dropped first when it is full
+    admission_queue_size = 1024
+
+    # structure keeping delayed responses, 'heap' or 'wheel', a timing wheel
+    # inserts in constant time when there are very many of them
+    delay_timers = 'heap'
+
+    # responses without delay are sent while receiving the request instead
+    # of passing them to the delay worker
+    inline_responses = True
+
     debug = lambda *args, **kw: None
 
+    # incremented on every change, used to invalidate cached option encodings
+    generation = 0
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        self.changed()
+
+    def debug_packet(self, title, packet):
+        """Pass packet formatted for the event log to debug, formatting is
+        skipped while debug is not set
+        """
+        if 'debug' in self.__dict__:
+            self.debug('{}:\n {}'.format(title, str(packet).replace('\n', '\n\t')))
+
+    def changed(self):
+        """Mark configuration as modified
+        """
+        self.__dict__['generation'] = self.generation + 1
+
+    def cached(self, name, function):
+        """Get function(configuration) computed once until configuration changes
+        """
+        cache = self.__dict__.get('_cache')
+        if cache is None or cache[0] != self.generation:
+            cache = self.__dict__['_cache'] = (self.generation, dict())
+        if name not in cache[1]:
+            cache[1][name] = function(self)
+        return cache[1][name]
+
+    def resolved_options(self):
+        """Get option number -> encoded value for options set in configuration
+        """
+        return self.cached('resolved_options', resolve_options)
+
     def load(self, file):
         """Load configuration from file using exec to parse file as object dictionary
         or get ALL command line arguments and change them using regexp to file layout
@@ -324,6 +1064,7 @@ class DHCPServerConfiguration(object):
             args = re.sub('^-', '', args)
             args = re.sub('^([a-z_]+)([ ]+)(.+)$', r"\1=\3", args, flags=re.MULTILINE)
             exec(args, self.__dict__)
+        self.changed()
 
     def adjust_if_this_computer_is_a_router(self):
         """Automatically adjust some DHCP configuration parameters if this computer is router
@@ -340,22 +1081,26 @@ class DHCPServerConfiguration(object):
                 #self.perform_mask_discovery = True
 
     def all_ip_addresses(self):
+        return iter(self.ip_address_pool())
+
+    def ip_address_pool(self):
+        """Get range of integer addresses given to clients, the first five
+        addresses of the network are left out
+        """
         ips = ip_addresses(self.network, self.subnet_mask)
-        for i in range(5):
-            next(ips)
-        return ips
+        return ips[5:]
 
     def network_filter(self):
-        return NETWORK(self.network, self.subnet_mask)
+        return self.cached('network_filter', lambda configuration: NETWORK(configuration.network, configuration.subnet_mask))
 
 def ip_addresses(network, subnet_mask):
-    import socket, struct
-    subnet_mask = struct.unpack('>I', socket.inet_aton(subnet_mask))[0]
-    network = struct.unpack('>I', socket.inet_aton(network))[0]
-    network = network & subnet_mask
+    """Get range of integer addresses of hosts in network
+    """
+    subnet_mask = ip_to_int(subnet_mask)
+    network = ip_to_int(network) & subnet_mask
     start = network + 1
     end = (network | (~subnet_mask & 0xffffffff))
-    return (socket.inet_ntoa(struct.pack('>I', i)) for i in range(start, end))
+    return range(start, end)
 
 class ALL(object):
     """Comparator class
@@ -379,10 +1124,10 @@ class NETWORK(object):
     """Comparator class to check if address within same network
     """
     def __init__(self, network, subnet_mask):
-        self.subnet_mask = struct.unpack('>I', inet_aton(subnet_mask))[0]
-        self.network = struct.unpack('>I', inet_aton(network))[0]
+        self.subnet_mask = ip_to_int(subnet_mask)
+        self.network = ip_to_int(network)
     def __eq__(self, other):
-        ip = struct.unpack('>I', inet_aton(other))[0]
+        ip = ip_to_int(other) if isinstance(other, str) else other
         return ip & self.subnet_mask == self.network and \
                ip - self.network and \
                ip - self.network != ~self.subnet_mask & 0xffffffff
@@ -411,6 +1156,12 @@ class CSVDatabase(object):
         """
         return open(self.file_name, mode)
 
+    def state(self):
+        """Get state of CSV file which changes whenever the file is written
+        """
+        stat = os.stat(self.file_name)
+        return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
     def get(self, pattern):
         """Get CSV entry representing host(MAC) and lease(IP)
         """
@@ -424,14 +1175,12 @@ class CSVDatabase(object):
             f.write(self.delimiter.join(line) + '\n')
 
     def delete(self, pattern):
-        """Delete host entry from CSV file
+        """Delete host entry from CSV file, the file is read and written once
         """
-        lines = self.all()
-        lines_to_delete = self.get(pattern)
-        self.file('w').close() # empty file
-        for line in lines:
-            if line not in lines_to_delete:
-                self.add(line)
+        pattern = list(pattern)
+        lines = [line for line in self.all() if pattern != line]
+        with self.file('w') as f:
+            f.writelines(self.delimiter.join(line) + '\n' for line in lines)
 
     def all(self):
         """Get all entries from CSV file
@@ -441,9 +1190,10 @@ class CSVDatabase(object):
 
 class Host(object):
     """Class representing host with MAC address, IP, hostname if available and last used timestamp
+    MAC and IP addresses are integers, they are converted to strings only when stored
     """
     def __init__(self, mac, ip, hostname, last_used):
-        self.mac = mac.upper()
+        self.mac = mac
         self.ip = ip
         self.hostname = hostname
         self.last_used = int(last_used)
@@ -452,14 +1202,14 @@ class Host(object):
     def from_tuple(cls, line):
         mac, ip, hostname, last_used = line
         last_used = int(last_used)
-        return cls(mac, ip, hostname, last_used)
+        return cls(mac_to_int(mac), ip_to_int(ip) if ip else 0, hostname, last_used)
 
     @classmethod
-    def from_packet(cls, packet):
-        return cls(packet.client_mac_address,
-                   packet.requested_ip_address or packet.client_ip_address,
+    def from_packet(cls, packet, last_used = None):
+        return cls(packet.chaddr,
+                   packet.requested_ip or packet.ciaddr,
                    packet.host_name or '',
-                   int(time.time()))
+                   int(time.time() if last_used is None else last_used))
 
     @staticmethod
     def get_pattern(mac = ALL, ip = ALL, hostname = ALL, last_used = ALL):
@@ -468,12 +1218,17 @@ class Host(object):
     def to_tuple(self):
         """Convert host to tuple
         """
-        return [self.mac, self.ip, self.hostname, str(int(self.last_used))]
+        return [int_to_mac(self.mac), int_to_ip(self.ip), self.hostname, str(int(self.last_used))]
+
+    def to_key(self):
+        """Convert host to list matched by patterns
+        """
+        return [self.mac, self.ip, self.hostname, self.last_used]
 
     def to_pattern(self):
-        """Convert host to pattern
+        """Convert host to pattern matching its stored tuple
         """
-        return self.get_pattern(ip = self.ip, mac = self.mac)
+        return self.get_pattern(ip = int_to_ip(self.ip), mac = CASEINSENSITIVE(int_to_mac(self.mac)))
 
     def __hash__(self):
         return hash(self.key)
@@ -484,157 +1239,545 @@ class Host(object):
     def has_valid_ip(self):
         """Check if host has valid IP address
         """
-        return self.ip and self.ip != '0.0.0.0'
+        return bool(self.ip)
         
-class HostDatabase(object):
+class ProcessLock(object):
+    """Lock shared by all processes which opened the same file, reentrant within a process
+    The file holds a counter incremented whenever a holder changed shared data
+    so other processes know when to read it again. Open the lock after fork,
+    processes sharing an inherited lock do not exclude each other.
+    """
     def __init__(self, file_name):
-        self.db = CSVDatabase(file_name)
+        self.fd = os.open(file_name, os.O_RDWR | os.O_CREAT, 0o644)
+        self.thread_lock = threading.RLock()
+        self.depth = 0
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+        if self.depth == 0:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+        self.depth += 1
+        return self
+
+    def __exit__(self, *args):
+        self.depth -= 1
+        if self.depth == 0:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.thread_lock.release()
+
+    @property
+    def generation(self):
+        return int.from_bytes(os.pread(self.fd, 8, 0), 'big')
+
+    def changed(self):
+        """Tell other processes that shared data changed, call while holding the lock
+        """
+        os.pwrite(self.fd, (self.generation + 1).to_bytes(8, 'big'), 0)
+
+    def close(self):
+        os.close(self.fd)
+
+class HostDatabase(object):
+    """Hosts stored in CSV file and indexed in memory by MAC and IP address
+    The file is parsed again only when it was changed by somebody else.
+    Processes sharing the file must pass a ProcessLock on it.
+    """
+    def __init__(self, file_name, lock = None, db = None):
+        """db stores the lines of the hosts, a CSVDatabase of file_name by default
+        """
+        self.db = db if db is not None else CSVDatabase(file_name)
+        self.lock = lock
+        self.file_state = None
+        self.hosts = dict() # id(host): host, in file order
+        self.by_mac = dict() # mac: [host, ...]
+        self.by_ip = dict() # ip: [host, ...]
+
+    def locked(self):
+        """Get context manager making changes atomic for all processes sharing the file
+        """
+        return self.lock if self.lock is not None else contextlib.nullcontext()
+
+    def state(self):
+        if self.lock is None:
+            return self.db.state()
+        # file state alone misses writes of other processes within one mtime tick
+        return self.db.state(), self.lock.generation
+
+    def written(self):
+        """Record that this process changed the file
+        """
+        if self.lock is not None:
+            self.lock.changed()
+        self.file_state = self.state()
+
+    def load(self):
+        """Read hosts from file if it changed since it was read last time
+        """
+        file_state = self.state()
+        if file_state == self.file_state:
+            return
+        self.hosts.clear()
+        self.by_mac.clear()
+        self.by_ip.clear()
+        for line in self.db.all():
+            try:
+                host = Host.from_tuple(line)
+            except (ValueError, OSError):
+                # empty or malformed line
+                continue
+            self._index(host)
+        self.file_state = file_state
+
+    def _index(self, host):
+        self.hosts[id(host)] = host
+        self.by_mac.setdefault(host.mac, []).append(host)
+        self.by_ip.setdefault(host.ip, []).append(host)
+
+    def _unindex(self, host):
+        for index, key in ((self.by_mac, host.mac), (self.by_ip, host.ip)):
+            hosts = index.get(key, [])
+            if host in hosts:
+                hosts.remove(host)
+            if not hosts:
+                index.pop(key, None)
+        del self.hosts[id(host)]
 
     def get(self, **kw):
+        self.load()
         pattern = Host.get_pattern(**kw)
-        return list(map(Host.from_tuple, self.db.get(pattern)))
+        return [host for host in self.hosts.values() if pattern == host.to_key()]
+
+    def get_by_mac(self, mac):
+        self.load()
+        return list(self.by_mac.get(mac, ()))
+
+    def get_by_ip(self, ip):
+        self.load()
+        return list(self.by_ip.get(ip, ()))
 
     def add(self, host):
-        self.db.add(host.to_tuple())
+        with self.locked():
+            self.load()
+            self.db.add(host.to_tuple())
+            self._index(host)
+            self.written()
 
     def delete(self, host = None, **kw):
-        if host is None:
-            pattern = Host.get_pattern(**kw)
-        else:
-            pattern = host.to_pattern()
-        self.db.delete(pattern)
+        with self.locked():
+            self.load()
+            if host is None:
+                pattern = Host.get_pattern(**kw)
+                self.db.delete(pattern)
+                self.written()
+                self.file_state = None
+                return
+            for known_host in self.get_by_mac(host.mac):
+                if known_host.ip == host.ip:
+                    self._unindex(known_host)
+            self.db.delete(host.to_pattern())
+            self.written()
 
     def all(self):
-        return list(map(Host.from_tuple, self.db.all()))
+        self.load()
+        return list(self.hosts.values())
 
     def replace(self, host):
-        self.delete(host)
-        self.add(host)
+        with self.locked():
+            self.delete(host)
+            self.add(host)
         
 def sorted_hosts(hosts):
     hosts = list(hosts)
-    hosts.sort(key = lambda host: (host.hostname.lower(), host.mac.lower(), host.ip.lower()))
+    hosts.sort(key = lambda host: (host.hostname.lower(), host.mac, host.ip))
     return hosts
 
 class DHCPServer(object):
     """Main DHCP server class that is handling incoming packets and sending responses
     using all other utility classes
     """
-    def __init__(self, configuration = None):
+    def __init__(self, configuration = None, clock = time):
+        """clock has the time() and monotonic() functions of the time module,
+        all timestamps and delays of the server are taken from it
+        """
         if configuration == None:
             configuration = DHCPServerConfiguration()
             
         self.configuration = configuration
-        #OPEN UDP SOCKET FOR HANDLING INCOMING DHCP PACKETS and SENDING RESPONSES
-        self.socket = socket(type = SOCK_DGRAM)
-        self.socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
-        self.socket.bind(('', 67))
-        self.delay_worker = TransactionDelayWorker()
+        self.clock = clock
+        self.socket = self.create_socket()
+        # True if received packets carry their ingress interface and address
+        self.packet_info = self.socket is not None and enable_packet_info(self.socket)
+        self.delay_worker = self.create_delay_worker()
+        self.reply_sockets = self.create_reply_sockets()
+        self.reply_sockets.fallback = self.socket
+        self.watch_socket = self.create_watch_socket()
+        self.other_servers = OtherServers()
         self.closed = False
-        self.transactions = collections.defaultdict(lambda: DHCPTransaction(self)) # id: transaction
-        self.hosts = HostDatabase(self.configuration.host_file)
-        self.time_started = time.time()
+        self.transactions = TransactionTable(self, configuration.max_transactions) # id: transaction
+        self.hosts = self.create_host_database()
+        self.leases = self.create_lease_table()
+        self.rate_limiter = self.create_rate_limiter()
+        self.admission = AdmissionQueue(self.configuration.admission_queue_size)
+        self.time_started = clock.time()
+
+    def create_socket(self):
+        """Open UDP socket handling incoming DHCP packets and sending responses
+        """
+        server_socket = socket(type = SOCK_DGRAM)
+        server_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        server_socket.bind(('', 67))
+        return server_socket
+
+    def create_delay_worker(self):
+        """Create worker delaying responses to clients
+        """
+        if self.configuration.delay_timers == 'wheel':
+            return TransactionDelayWorker(TimingWheel(now = self.clock.monotonic()), self.clock.monotonic)
+        return TransactionDelayWorker(clock = self.clock.monotonic)
+
+    def create_reply_sockets(self):
+        """Create sockets sending responses from every server address
+        """
+        return ReplySockets()
+
+    def create_watch_socket(self):
+        """Open socket receiving replies of other servers to clients in
+        competitive delay mode, None if it is not used
+        """
+        if not self.configuration.competitive_delay:
+            return None
+        watch_socket = socket(type = SOCK_DGRAM)
+        watch_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        watch_socket.bind(('', 68))
+        enable_packet_info(watch_socket)
+        return watch_socket
+
+    def create_host_database(self):
+        """Open HostDatabase of configuration.host_file
+        """
+        return HostDatabase(self.configuration.host_file, self.create_host_lock())
+
+    def create_host_lock(self):
+        """Create lock of host database shared with other processes, None if there are none
+        """
+        return None
+
+    def create_lease_table(self):
+        """Open LeaseTable addresses are allocated from, None to choose them
+        from the host database
+        """
+        return None
+
+    def create_rate_limiter(self):
+        """Create RateLimiter of received packets
+        """
+        configuration = self.configuration
+        return RateLimiter(configuration.client_rate_limit, configuration.client_rate_burst,
+                           configuration.global_rate_limit, configuration.global_rate_burst,
+                           clock = self.clock.monotonic)
 
     def close(self):
-        self.socket.close()
+        if self.socket is not None:
+            self.socket.close()
+        if self.watch_socket is not None:
+            self.watch_socket.close()
         self.closed = True
         self.delay_worker.close()
+        self.reply_sockets.close()
+        if self.hosts.lock is not None:
+            self.hosts.lock.close()
+        if self.leases is not None:
+            self.leases.close()
         for transaction in list(self.transactions.values()):
             transaction.close()
 
     def update(self, timeout = 0):
-        try:
-            reads = select.select([self.socket], [], [], timeout)[0]
-        except ValueError:
-            # ValueError: file descriptor cannot be a negative integer (-1)
-            return
-        for socket in reads:
+        # packets are read ahead of handling them so the admission queue can
+        # choose which ones to handle when more arrive than can be handled
+        read = 0
+        if self.admission:
+            timeout = 0
+        while read < self.admission.read_batch:
             try:
-                packet = ReadBootProtocolPacket(*socket.recvfrom(4096))
-            except OSError:
-                # OSError: [WinError 10038] An operation was attempted on something that is not a socket
-                pass
-            else:
-                self.received(packet)
-        for transaction_id, transaction in list(self.transactions.items()):
-            if transaction.is_done():
-                transaction.close()
-                self.transactions.pop(transaction_id)
+                # unicast to a server address is received by its more specific reply socket
+                reads = select.select(self.sockets(), [], [], timeout)[0]
+            except (ValueError, OSError):
+                # ValueError: file descriptor cannot be a negative integer (-1)
+                # OSError: [Errno 9] Bad file descriptor, socket closed by another thread or signal
+                return
+            if not reads:
+                break
+            timeout = 0
+            for socket in reads:
+                try:
+                    packet = self.receive_packet(socket)
+                except OSError:
+                    # OSError: [WinError 10038] An operation was attempted on something that is not a socket
+                    pass
+                else:
+                    if packet is None:
+                        pass
+                    elif socket is self.watch_socket:
+                        self.watched(packet)
+                    else:
+                        self.admit(packet)
+                read += 1
+        self.admission.serve(self.handle, self.admission.serve_batch)
+        self.remove_done_transactions()
+
+    def sockets(self):
+        """Get sockets to read packets from
+        """
+        sockets = [self.socket] + self.reply_sockets.sockets()
+        if self.watch_socket is not None:
+            sockets.append(self.watch_socket)
+        return sockets
+
+    def receive_packet(self, socket):
+        """Read packet from socket, None if it is not for this server
+        """
+        if self.packet_info:
+            data, address, ingress, destination = receive_datagram(socket)
+            return LazyBootProtocolPacket(data, address, ingress)
+        return LazyBootProtocolPacket(*socket.recvfrom(4096))
+
+    def serves(self, packet):
+        """Check if packet arrived on an interface listed in configuration.interfaces
+        """
+        ingress = getattr(packet, 'ingress', None)
+        if self.configuration.interfaces is None or ingress is None:
+            return True
+        return ingress[0] in self.configuration.cached('interface_indexes', interface_indexes)
+
+    def remove_done_transactions(self):
+        return self.transactions.remove_expired()
+
+    @staticmethod
+    def client_key(packet):
+        """Get key identifying client of packet, client identifier option or hardware address
+        """
+        client_identifier = packet.get_option_bytes(61)
+        if client_identifier:
+            return bytes(client_identifier)
+        return packet.chaddr
+
+    @staticmethod
+    def segment(packet):
+        """Get key of network segment packet came from, relay agent address or
+        index of the interface it arrived on
+        """
+        if packet.giaddr:
+            return packet.giaddr
+        ingress = getattr(packet, 'ingress', None)
+        return None if ingress is None else ingress[0]
+
+    def watched(self, packet):
+        """Handle reply of a server to a client seen in competitive delay mode,
+        our pending response to the client is dropped
+        """
+        if packet.message_type != 2 or packet.dhcp_message_type not in ('DHCPOFFER', 'DHCPACK'):
+            return
+        if self.is_own_address(packet.server_identifier) or self.is_own_address(packet.host):
+            return
+        self.configuration.debug_packet('other server replied', packet)
+        self.other_servers.answered(self.segment(packet))
+        transaction = self.transactions.get(packet.transaction_id)
+        if transaction is not None and not transaction.done:
+            self.other_servers.transactions_closed += 1
+            # the client is served, retransmissions are left to the other server
+            transaction.reply = None
+            transaction.close()
+
+    def is_own_address(self, address):
+        """Check if address is one this server sends replies from
+        """
+        return address in self.reply_sockets.by_address
+
+    def chose_other_server(self, request):
+        """Check if request in competitive delay mode selects the offer of
+        another server, which shows that server is alive on its segment
+        """
+        if not self.configuration.competitive_delay:
+            return False
+        server_identifier = request.server_identifier
+        if server_identifier is None or self.is_own_address(server_identifier):
+            return False
+        self.configuration.debug_packet('client chose other server', request)
+        self.other_servers.chosen(self.segment(request))
+        return True
+
+    def response_delay(self, packet, seconds):
+        """Get seconds to wait before responding to packet, shorter in competitive
+        delay mode if other servers stopped answering on its segment
+        """
+        if not self.configuration.competitive_delay or self.other_servers.alive(self.segment(packet)):
+            return seconds
+        return min(seconds, self.configuration.competitive_minimum_delay)
+
+    def unanswered(self, packet, retransmitted = False):
+        """Note that no other server answered packet before our response was due
+        Only counted if a reply would have been seen, it is broadcast if the
+        client asks for it, or if the client sent the request again. Unicast
+        replies and those to relay agents do not reach the watch socket.
+        """
+        if self.configuration.competitive_delay and (retransmitted or packet.bootp_flags & BROADCAST_FLAG):
+            self.other_servers.missed(self.segment(packet))
+
+    def offenders(self, count = 10):
+        """Get (client, dropped packets) of clients dropped most by rate limiting
+        """
+        return [(int_to_mac(client) if isinstance(client, int) else client.hex(':'), drops)
+                for client, drops in self.rate_limiter.offenders(count)]
 
     def received(self, packet):
+        """Handle packet received from a client at once
+        """
+        if self.admit(packet):
+            self.admission.serve(self.handle)
+
+    def admit(self, packet):
+        """Queue packet received from a client for handling, False if it is dropped
+        """
+        if not self.serves(packet):
+            self.configuration.debug_packet('not serving interface of', packet)
+            return False
+        if not self.rate_limiter.allow(self.client_key(packet)):
+            return False
+        return self.admission.put(packet)
+
+    def handle(self, packet):
+        """Pass admitted packet to its transaction
+        """
         if not self.transactions[packet.transaction_id].receive(packet):
-            self.configuration.debug('received:\n {}'.format(str(packet).replace('\n', '\n\t')))
+            self.configuration.debug_packet('received', packet)
             
     def client_has_chosen(self, packet):
-        self.configuration.debug('client_has_chosen:\n {}'.format(str(packet).replace('\n', '\n\t')))
-        host = Host.from_packet(packet)
+        self.configuration.debug_packet('client_has_chosen', packet)
+        host = Host.from_packet(packet, self.clock.time())
         if not host.has_valid_ip():
             return
+        if self.leases is not None:
+            self.leases.commit(host.mac, host.ip, self.clock.time() + self.configuration.ip_address_lease_time)
         self.hosts.replace(host)
 
     def is_valid_client_address(self, address):
         if address is None:
             return False
-        a = address.split('.')
-        s = self.configuration.subnet_mask.split('.')
-        n = self.configuration.network.split('.')
-        return all(s[i] == '0' or a[i] == n[i] for i in range(4))
+        network = self.configuration.network_filter()
+        return address & network.subnet_mask == network.network & network.subnet_mask
 
     def get_ip_address(self, packet):
-        mac_address = packet.client_mac_address
-        requested_ip_address = packet.requested_ip_address
-        known_hosts = self.hosts.get(mac = CASEINSENSITIVE(mac_address))
+        """Choose IP address for client, addresses are integers, None if none is left
+        The choice is atomic for all processes sharing the host database
+        """
+        if self.leases is not None:
+            return self.lease_ip_address(packet)
+        with self.hosts.locked():
+            return self.choose_ip_address(packet)
+
+    def lease_ip_address(self, packet):
+        """Choose IP address for client from the lease table and offer it
+        until the transaction ends
+        """
+        mac_address = packet.chaddr
+        now = self.clock.time()
+        ip = self.leases.allocate(mac_address, packet.requested_ip,
+                                  now + self.configuration.length_of_transaction, now)
+        if ip is None:
+            self.configuration.debug('no address left for {}'.format(int_to_mac(mac_address)))
+            return None
+        if not any(host.ip == ip for host in self.hosts.get_by_mac(mac_address)):
+            self.configuration.debug('add {} {} {}'.format(int_to_mac(mac_address), int_to_ip(ip), packet.host_name))
+            self.hosts.replace(Host(mac_address, ip, packet.host_name or '', self.clock.time()))
+        return ip
+
+    def choose_ip_address(self, packet):
+        mac_address = packet.chaddr
+        requested_ip_address = packet.requested_ip
+        known_hosts = self.hosts.get_by_mac(mac_address)
         ip = None
         if known_hosts:
             # 1. choose known ip address
             for host in known_hosts:
                 if self.is_valid_client_address(host.ip):
                     ip = host.ip
-            self.configuration.debug('known ip:{}'.format(ip))
+            self.configuration.debug('known ip:{}'.format(ip and int_to_ip(ip)))
         if ip is None and self.is_valid_client_address(requested_ip_address):
             # 2. choose valid requested ip address
             ip = requested_ip_address
-            self.configuration.debug('valid ip:{}'.format(ip))
+            self.configuration.debug('valid ip:{}'.format(int_to_ip(ip)))
         if ip is None:
             # 3. choose new, free ip address
             chosen = False
-            network_hosts = self.hosts.get(ip = self.configuration.network_filter())
+            # read the file once, not for every candidate
+            self.hosts.load()
+            used = self.hosts.by_ip
             for ip in self.configuration.all_ip_addresses():
-                if not any(host.ip == ip for host in network_hosts):
+                if ip not in used:
                     chosen = True
                     break
             if not chosen:
                 # 4. reuse old valid ip address
+                network_hosts = self.hosts.get(ip = self.configuration.network_filter())
+                if not network_hosts:
+                    self.configuration.debug('no address left for {}'.format(int_to_mac(mac_address)))
+                    return None
                 network_hosts.sort(key = lambda host: host.last_used)
                 ip = network_hosts[0].ip
                 assert self.is_valid_client_address(ip)
-            self.configuration.debug('new ip:'.format(ip))
+            self.configuration.debug('new ip:{}'.format(int_to_ip(ip)))
         if not any([host.ip == ip for host in known_hosts]):
-            self.configuration.debug('add {} {}'.format(mac_address, ip, packet.host_name))
-            self.hosts.replace(Host(mac_address, ip, packet.host_name or '', time.time()))
+            self.configuration.debug('add {} {} {}'.format(int_to_mac(mac_address), int_to_ip(ip), packet.host_name))
+            self.hosts.replace(Host(mac_address, ip, packet.host_name or '', self.clock.time()))
         return ip
 
     @property
     def server_identifiers(self):
-        return get_host_ip_addresses()
-
-    def broadcast(self, packet):
-        self.configuration.debug('broadcasting:\n {}'.format(str(packet).replace('\n', '\n\t')))
-        for addr in self.server_identifiers:
-            broadcast_socket = socket(type = SOCK_DGRAM)
-            broadcast_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
-            broadcast_socket.setsockopt(SOL_SOCKET, SO_BROADCAST, 1)
-            packet.server_identifier = addr
-            broadcast_socket.bind((addr, 67))
-            try:
-                data = packet.to_bytes()
-                broadcast_socket.sendto(data, ('255.255.255.255', 68))
-                broadcast_socket.sendto(data, (addr, 68))
-            finally:
-                broadcast_socket.close()
+        return self.reply_sockets.addresses
+
+    def reply_destination(self, packet):
+        """Get (host, port) reply packet is delivered to following RFC 2131 4.1,
+        None if it must be broadcast
+        """
+        if packet.giaddr:
+            # relay agent, it delivers the reply on the client segment
+            return int_to_ip(packet.giaddr), 67
+        if packet.ciaddr:
+            return int_to_ip(packet.ciaddr), 68
+        if not packet.bootp_flags & BROADCAST_FLAG and packet.yiaddr and packet.chaddr is not None \
+                and self.reply_sockets.add_arp_entry(packet.yiaddr, packet.chaddr):
+            return int_to_ip(packet.yiaddr), 68
+        return None
+
+    def reply_address(self, ingress = None):
+        """Get server address replies are unicast from, the local address the
+        request arrived on or the one in the served network if any
+        """
+        if ingress is not None:
+            return int_to_ip(ingress[1])
+        network = self.configuration.network_filter()
+        for address in self.server_identifiers:
+            if network == ip_to_int(address):
+                return address
+        return None
+
+    def broadcast(self, packet, request = None):
+        """Deliver reply packet to client, only on the interface request arrived on if it is known
+        """
+        ingress = getattr(request, 'ingress', None)
+        destination = self.reply_destination(packet)
+        if destination is None:
+            self.configuration.debug_packet('broadcasting', packet)
+            sent = self.reply_sockets.send(packet, ingress = ingress)
+        else:
+            self.configuration.debug_packet('sending to {}'.format(destination), packet)
+            sent = self.reply_sockets.send_to(packet, destination, self.reply_address(ingress), ingress)
+        if not sent:
+            self.configuration.debug('reply {} dropped, no socket to send it from'.format(packet.transaction_id))
 
     def run(self):
         self.configuration.debug("DHCP server starting")
+        self.reply_sockets.refresh(force = True)
         while not self.closed:
             try:
                 self.update(1)
@@ -655,12 +1798,299 @@ class DHCPServer(object):
             if line:
                 self.configuration.debug(line)
 
+    def statistics(self):
+        """Get counters describing server activity
+        """
+        statistics = self.transactions.statistics()
+        statistics.update(self.reply_sockets.statistics())
+        statistics.update(WriteBootProtocolPacket.template_cache.statistics())
+        statistics.update(self.rate_limiter.statistics())
+        statistics.update(self.admission.statistics())
+        if self.configuration.competitive_delay:
+            statistics.update(self.other_servers.statistics())
+        if self.leases is not None:
+            statistics.update(self.leases.statistics())
+            statistics['lease_allocations'] = self.leases.allocations
+            statistics['lease_reclaims'] = self.leases.reclaims
+        return statistics
+
     def get_all_hosts(self):
         return sorted_hosts(self.hosts.get())
 
     def get_current_hosts(self):
         return sorted_hosts(self.hosts.get(last_used = GREATER(self.time_started)))
 
+class DHCPServerProtocol(asyncio.DatagramProtocol):
+    """asyncio protocol passing received datagrams to DHCPServer
+    """
+    def __init__(self, server):
+        self.server = server
+
+    def datagram_received(self, data, address):
+        try:
+            self.server.received(LazyBootProtocolPacket(data, address))
+        except:
+            traceback.print_exc()
+
+    def error_received(self, exception):
+        pass
+
+class AsyncioDHCPServer(DHCPServer):
+    """DHCP server running in an asyncio event loop
+    Received packets, delayed responses and transaction expiry are all handled
+    by the loop so no helper threads are needed. Methods must be called from
+    the thread running the loop.
+    """
+    def __init__(self, configuration = None, loop = None):
+        self.loop = loop if loop is not None else asyncio.new_event_loop()
+        self.transport = None
+        self.started = False
+        self.serving = False
+        self.stopped = self.loop.create_future()
+        super().__init__(configuration)
+
+    def create_delay_worker(self):
+        return AsyncioDelayWorker(self.loop)
+
+    def create_reply_sockets(self):
+        return ReplySockets(changed = self._reply_sockets_changed)
+
+    def _reply_sockets_changed(self, opened, closed):
+        for reply_socket in closed:
+            self.loop.remove_reader(reply_socket)
+        for reply_socket in opened:
+            reply_socket.setblocking(False)
+            self.loop.add_reader(reply_socket, self._read_socket, reply_socket)
+
+    def _read_socket(self, socket):
+        # read ahead of handling, like DHCPServer.update
+        for i in range(self.admission.read_batch):
+            try:
+                packet = self.receive_packet(socket)
+            except OSError:
+                # BlockingIOError: no more datagrams
+                return
+            if packet is not None:
+                try:
+                    self.received(packet)
+                except:
+                    traceback.print_exc()
+
+    def received(self, packet):
+        """Queue packet, the queue is served after the loop read all ready sockets
+        """
+        if self.admit(packet):
+            self._schedule_serving()
+
+    def _schedule_serving(self):
+        if not self.serving:
+            self.serving = True
+            self.loop.call_soon(self._serve_admitted)
+
+    def _serve_admitted(self):
+        self.serving = False
+        try:
+            self.admission.serve(self.handle, self.admission.serve_batch)
+        finally:
+            if self.admission and not self.closed:
+                self._schedule_serving()
+
+    async def start(self):
+        """Start receiving packets in the event loop
+        """
+        self.started = True
+        self.socket.setblocking(False)
+        await self.start_receiving()
+        if self.watch_socket is not None:
+            self.watch_socket.setblocking(False)
+            self.loop.add_reader(self.watch_socket, self._read_watch_socket)
+        self.reply_sockets.refresh(force = True)
+        self.loop.call_later(1, self._remove_done_transactions_periodically)
+
+    async def start_receiving(self):
+        if self.packet_info:
+            # datagram transports do not pass the ingress interface
+            self.loop.add_reader(self.socket, self._read_socket, self.socket)
+        else:
+            self.transport, protocol = await self.loop.create_datagram_endpoint(
+                lambda: DHCPServerProtocol(self), sock = self.socket)
+
+    def _read_watch_socket(self):
+        try:
+            packet = self.receive_packet(self.watch_socket)
+        except OSError:
+            return
+        if packet is not None:
+            self.watched(packet)
+
+    def _remove_done_transactions_periodically(self):
+        if not self.closed:
+            self.remove_done_transactions()
+            self.loop.call_later(1, self._remove_done_transactions_periodically)
+
+    async def serve_forever(self):
+        """Receive packets until the server is closed
+        """
+        if not self.started:
+            await self.start()
+        await self.stopped
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+        elif self.started and not self.closed:
+            self.loop.remove_reader(self.socket)
+        if self.watch_socket is not None and self.started and not self.closed:
+            self.loop.remove_reader(self.watch_socket)
+        super().close()
+        if not self.stopped.done():
+            self.stopped.set_result(None)
+
+    def run(self):
+        self.configuration.debug("DHCP server starting")
+        try:
+            self.loop.run_until_complete(self.serve_forever())
+        except KeyboardInterrupt:
+            pass
+        self.configuration.debug("DHCP server closing")
+
+class ReusePortWorker(object):
+    """Mixin making DHCP server one of worker processes sharing the DHCP port
+    Every worker binds the port with SO_REUSEPORT and the kernel spreads
+    unicast datagrams over them. Broadcast datagrams reach every worker so
+    each handles only those of clients whose chaddr belongs to it. Addresses
+    are allocated from a LeaseTable in shared memory, the host database is
+    written under a lock shared by all workers. Linux only.
+    """
+    def __init__(self, configuration = None, worker = 0, workers = 1, port = 67, **kw):
+        self.worker = worker
+        self.workers = workers
+        self.port = port
+        super().__init__(configuration, **kw)
+
+    def create_socket(self):
+        server_socket = socket(type = SOCK_DGRAM)
+        server_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        server_socket.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+        server_socket.bind(('', self.port))
+        return server_socket
+
+    def create_reply_sockets(self):
+        reply_sockets = super().create_reply_sockets()
+        reply_sockets.port = self.port
+        reply_sockets.reuse_port = True
+        return reply_sockets
+
+    def create_host_lock(self):
+        return ProcessLock(self.configuration.host_file + '.lock')
+
+    def create_lease_table(self):
+        return LeaseTable(lease_table_file(self.configuration))
+
+    def broadcast_addresses(self):
+        return self.configuration.cached('broadcast_addresses', lambda configuration:
+            {ip_to_int('255.255.255.255'), ip_to_int(configuration.broadcast_address)})
+
+    def receive_packet(self, socket):
+        # the destination address tells broadcast from unicast
+        data, address, ingress, destination = receive_datagram(socket)
+        packet = LazyBootProtocolPacket(data, address, ingress)
+        if destination in self.broadcast_addresses() and len(data) >= 240 and \
+                packet.chaddr % self.workers != self.worker:
+            return None
+        return packet
+
+class WorkerDHCPServer(ReusePortWorker, DHCPServer):
+    """Threaded DHCP server running as one of worker processes
+    """
+
+class AsyncioWorkerDHCPServer(ReusePortWorker, AsyncioDHCPServer):
+    """asyncio DHCP server running as one of worker processes
+    """
+
+def lease_table_file(configuration):
+    return configuration.host_file + '.leases'
+
+def create_lease_table(configuration):
+    """Create lease table shared by worker processes from the host database,
+    hosts seen last are kept if they share an address
+    """
+    leases = LeaseTable.create(lease_table_file(configuration), configuration.ip_address_pool())
+    for host in HostDatabase(configuration.host_file).all():
+        leases.commit(host.mac, host.ip, host.last_used + configuration.ip_address_lease_time)
+    return leases
+
+def run_worker(configuration, worker, workers, engine = 'threaded', port = 67, server_class = None):
+    """Serve DHCP in worker process until SIGTERM
+    server_class replaces the worker server class of engine
+    """
+    if server_class is None:
+        server_class = AsyncioWorkerDHCPServer if engine == 'asyncio' else WorkerDHCPServer
+    server = server_class(configuration, worker, workers, port)
+    if isinstance(server, AsyncioDHCPServer):
+        server.loop.add_signal_handler(signal.SIGTERM, server.close)
+    else:
+        signal.signal(signal.SIGTERM, lambda *args: server.close())
+    server.run()
+
+def start_workers(configuration, workers, engine = 'threaded', port = 67, server_class = None):
+    """Fork worker processes serving DHCP, returns their process ids
+    Call before starting any threads
+    """
+    create_lease_table(configuration).close()
+    pids = []
+    for worker in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                run_worker(configuration, worker, workers, engine, port, server_class)
+            except:
+                traceback.print_exc()
+            finally:
+                os._exit(0)
+        pids.append(pid)
+    return pids
+
+def stop_workers(pids):
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    for pid in pids:
+        os.waitpid(pid, 0)
+
+def control_command(control, command):
+    """Get response of the control interface to command
+    control has hosts, events, configuration and statistics set like ThreadedTCPServer
+    """
+    if command == "hosts":
+        return "Active Hosts:\r\n{}".format("\r\n".join(map(";".join, control.hosts.all())))
+    elif command == "events":
+        return "Events last 24h:\r\n{}".format("\r\n".join(map(str, control.events.items())))
+    elif command == "configuration":
+        return "Current configuration\r\n" + "".join(
+            "{}: {}\r\n".format(value[0], getattr(control.configuration, value[0]))
+            for value in options if hasattr(control.configuration, value[0]))
+    elif command == "statistics":
+        return "Statistics:\r\n{}".format("\r\n".join("{}: {}".format(name, value) for name, value in control.statistics().items()))
+    elif command == "offenders":
+        offenders = getattr(control, 'offenders', None)
+        if offenders is None:
+            return "rate limiting is not available"
+        return "Clients dropped by rate limiting:\r\n{}".format("\r\n".join("{}: {}".format(client, drops) for client, drops in offenders()))
+    elif command == "help":
+        return ("hosts\t\tdisplay host database\r\n"
+                "events\t\tdisplay DHCP event log\r\n"
+                "configuration\tdisplay current server configuration\r\n"
+                "statistics\tdisplay server counters\r\n"
+                "offenders\tdisplay clients dropped most by rate limiting\r\n"
+                "help\t\tthis command\r\n"
+                "quit\t\tdisconnect from current session\r\n")
+    elif command == "quit":
+        return "bye\r\n"
+    return "unknown command: {}".format(command)
+
 class ThreadedTCPRequestHandler(socketserver.StreamRequestHandler):
     """Control socket client connection handler
     """
@@ -671,32 +2101,15 @@ class ThreadedTCPRequestHandler(socketserver.StreamRequestHandler):
         try:
             while(True):
                 self.request.sendall(bytes("\r\npydhcp ?> ", 'ascii'))
-                data = self.rfile.readline().strip()
-                if(data.decode() == "hosts"):
-                    self.request.sendall(bytes("Active Hosts:\r\n{}".format("\r\n".join(self.server.hosts.all())),'ascii'))
-                elif(data.decode() == "events"):
-                    self.request.sendall(bytes("Events last 24h:\r\n{}".format("\r\n".join(map(str,self.server.events.items()))),'ascii'))
-                elif(data.decode() == "configuration"):
-                    self.request.sendall(bytes("Current configuration\r\n", 'ascii'))
-                    for value in options:
-                        if(hasattr(self.server.configuration,value[0])):
-                            self.request.sendall(bytes("{}: {}\r\n".format(value[0],getattr(self.server.configuration,value[0])),'ascii'))
-                elif(data.decode() == "help"):
-                    self.request.sendall(bytes("hosts\t\tdisplay host database\r\n",'ascii'))
-                    self.request.sendall(bytes("events\t\tdisplay DHCP event log\r\n",'ascii'))
-                    self.request.sendall(bytes("configuration\tdisplay current server configuration\r\n",'ascii'))
-                    self.request.sendall(bytes("help\t\tthis command\r\n",'ascii'))
-                    self.request.sendall(bytes("quit\t\tdisconnect from current session\r\n",'ascii'))
-                elif(data.decode() == "quit"):
-                    self.request.sendall(bytes("bye\r\n", 'ascii'))
+                command = self.rfile.readline().strip().decode('ascii')
+                self.request.sendall(bytes(control_command(self.server, command), 'ascii'))
+                if command == "quit":
                     break
-                else:
-                    self.request.sendall(bytes("unknown command: {}".format(data.decode('ascii')), 'ascii'))
         except Exception as e:
             pass
 
-class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
-    """DHCP server control interface TCP server
+class ControlInterface(object):
+    """References to server state shown by the control interface
     """
     def setEvents(self,data):
         """Set DHCP events dictionary reference
@@ -713,6 +2126,79 @@ class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
         """
         self.configuration = data
 
+    def setStatistics(self,data):
+        """Set DHCP server statistics function reference
+        """
+        self.statistics = data
+
+    def setOffenders(self,data):
+        """Set DHCP server function listing clients dropped by rate limiting
+        """
+        self.offenders = data
+
+class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer, ControlInterface):
+    """DHCP server control interface TCP server
+    """
+
+class AsyncioControlServer(ControlInterface):
+    """DHCP server control interface TCP server running in an asyncio event loop
+    """
+    server = None
+
+    async def start(self, address):
+        """Start accepting connections on (host, port)
+        """
+        self.server = await asyncio.start_server(self.handle, *address)
+
+    async def handle(self, reader, writer):
+        """Handle client connection parsing commands and giving response to them
+        """
+        writer.write(bytes("Welcome to micro python dhcp server", 'ascii'))
+        try:
+            while True:
+                writer.write(bytes("\r\npydhcp ?> ", 'ascii'))
+                await writer.drain()
+                line = await reader.readline()
+                if not line:
+                    break
+                command = line.strip().decode('ascii')
+                writer.write(bytes(control_command(self, command), 'ascii'))
+                if command == "quit":
+                    await writer.drain()
+                    break
+        except Exception as e:
+            pass
+        finally:
+            writer.close()
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+
+
+def pop_argument(name, default = None):
+    """Remove command line argument name and its value from sys.argv
+    Returns the value or default if argument is not given
+    """
+    if name not in sys.argv:
+        return default
+    index = sys.argv.index(name)
+    value = sys.argv[index + 1]
+    del sys.argv[index:index + 2]
+    return value
+
+async def run_asyncio(server, control, address):
+    """Run DHCP server and control interface listening on address in the event loop
+    until Enter is pressed
+    """
+    await server.start()
+    await control.start(address)
+    print("DHCP Server and Control Server running in asyncio event loop")
+    try:
+        await server.loop.run_in_executor(None, input, "Enter to exit")
+    finally:
+        control.close()
+        server.close()
 
 if __name__ == "__main__":
     HOST, PORT = "localhost", 6868
@@ -723,8 +2209,13 @@ if __name__ == "__main__":
             type = 'debug'
         messages[time.time()] = { 'type': type, 'msg': msg }
 
-    if(len(sys.argv) == 1):
+    # threaded or asyncio
+    engine = pop_argument('--engine', 'threaded')
+    # number of processes sharing the DHCP port
+    workers = int(pop_argument('--workers', '1'))
+    if(len(sys.argv) == 1 or engine not in ('threaded', 'asyncio')):
         print('configuration file or command line options must be passed')
+        print('usage: dhcp.py [--engine threaded|asyncio] [--workers N] dhcp.conf')
         sys.exit()
 
     configuration = DHCPServerConfiguration()
@@ -733,28 +2224,54 @@ if __name__ == "__main__":
     configuration.load(sys.argv[1])
     configuration.router #+= ['192.168.0.1']
     configuration.ip_address_lease_time = 60
-    server = DHCPServer(configuration)
-    
-    for ip in server.configuration.all_ip_addresses():
-        assert ip == server.configuration.network_filter()
 
-    s = server.run_in_thread()
-    print("UDP DHCP Server loop running in thread:", s.name)
-    
-    cserver = ThreadedTCPServer((HOST, PORT), ThreadedTCPRequestHandler)
-    with cserver:
-        cserver.setEvents(messages)
-        cserver.setHosts(server.hosts.db)
-        cserver.setConfiguration(configuration)
-        # Start a thread with the server -- that thread will then start one
-        # more thread for each request
-        cserver_thread = threading.Thread(target=cserver.serve_forever)
-        # Exit the server thread when the main thread terminates
-        cserver_thread.daemon = True
-        cserver_thread.start()
-        print("Control Server loop running in thread:", cserver_thread.name)
-
-        input("Enter to exit")
-        cserver.shutdown()
-    
-    server.close()
+    for ip in configuration.all_ip_addresses():
+        assert ip == configuration.network_filter()
+
+    if workers > 1:
+        # fork before any thread is started
+        pids = start_workers(configuration, workers, engine)
+        print("DHCP Server running in worker processes:", ' '.join(map(str, pids)))
+        hosts = CSVDatabase(configuration.host_file)
+        leases = LeaseTable(lease_table_file(configuration))
+        statistics = lambda: dict(workers = len(pids), **leases.statistics())
+        cserver = ThreadedTCPServer((HOST, PORT), ThreadedTCPRequestHandler)
+    else:
+        if engine == 'asyncio':
+            server = AsyncioDHCPServer(configuration)
+            cserver = AsyncioControlServer()
+        else:
+            server = DHCPServer(configuration)
+            cserver = ThreadedTCPServer((HOST, PORT), ThreadedTCPRequestHandler)
+        hosts = server.hosts.db
+        statistics = server.statistics
+        cserver.setOffenders(server.offenders)
+
+    cserver.setEvents(messages)
+    cserver.setHosts(hosts)
+    cserver.setConfiguration(configuration)
+    cserver.setStatistics(statistics)
+
+    if workers == 1 and engine == 'asyncio':
+        server.loop.run_until_complete(run_asyncio(server, cserver, (HOST, PORT)))
+    else:
+        if workers == 1:
+            s = server.run_in_thread()
+            print("UDP DHCP Server loop running in thread:", s.name)
+
+        with cserver:
+            # Start a thread with the server -- that thread will then start one
+            # more thread for each request
+            cserver_thread = threading.Thread(target=cserver.serve_forever)
+            # Exit the server thread when the main thread terminates
+            cserver_thread.daemon = True
+            cserver_thread.start()
+            print("Control Server loop running in thread:", cserver_thread.name)
+
+            input("Enter to exit")
+            cserver.shutdown()
+
+        if workers == 1:
+            server.close()
+        else:
+            stop_workers(pids)
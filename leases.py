@@ -0,0 +1,424 @@
+"""Lease table in shared memory for DHCP server worker processes
+
+The table lives in a memory mapped file so every worker allocates addresses
+from the same pool without asking another process. The file contains
+
+header      magic, pool and index dimensions
+records     one per address of the pool: sequence, state, mac, expiry
+bitmap      one bit per record, set if the address is free
+index       hash table mac -> record, split into stripes
+
+Lookups do not lock, records are read with sequence counters which are odd
+while a record is written. Changes lock one index stripe and one pool stripe
+at a time with fcntl byte range locks, so workers serving different clients
+rarely wait for each other. Index stripes are always locked before pool
+stripes. Linux / Unix only.
+"""
+
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+
+from listener import int_to_ip, int_to_mac
+
+# record states
+FREE = 0
+OFFERED = 1
+LEASED = 2
+
+state_names = {FREE: 'free', OFFERED: 'offered', LEASED: 'leased'}
+
+MAGIC = b'DHCPLEAS'
+VERSION = 1
+
+header = struct.Struct('<8sIIIII')   # magic, version, first ip, pool size, stripes, slots per stripe
+HEADER_SIZE = 64
+record = struct.Struct('<IIQQ')      # sequence, state, mac, expiry
+sequence = struct.Struct('<I')
+record_data = struct.Struct('<IQQ')  # state, mac, expiry
+slot = struct.Struct('<QI4x')        # mac, record index + 1, 0 if slot was never used
+
+# fcntl locks are taken on one byte per stripe from here on, index stripes
+# first, the bytes only name the locks and do not protect their content
+LOCK_OFFSET = 1 << 40
+
+def stripe_count(pool_size):
+    """Number of stripes, small pools get few stripes so that index stripes
+    do not overflow when MAC addresses hash unevenly
+    """
+    return max(1, min(64, pool_size // 64))
+
+def slots_per_stripe(pool_size, stripes):
+    """Index slots per stripe, a power of two at least twice the records per stripe
+    """
+    records = -(-pool_size // stripes)
+    slots = 8
+    while slots < 2 * records + 16:
+        slots *= 2
+    return slots
+
+def mac_hash(mac):
+    return (mac * 0x9e3779b97f4a7c15) & 0xffffffffffffffff
+
+class LeaseTable(object):
+    """Addresses of a pool leased to MAC addresses, shared by processes
+    Addresses and MAC addresses are integers, expiry is a unix timestamp
+    """
+    @classmethod
+    def create(cls, file_name, pool):
+        """Create empty table file for pool, a range of integer addresses,
+        replacing an existing one
+        """
+        stripes = stripe_count(len(pool))
+        slots = slots_per_stripe(len(pool), stripes)
+        layout = cls.layout(len(pool), stripes, slots)
+        with open(file_name, 'wb') as file:
+            file.write(header.pack(MAGIC, VERSION, pool.start, len(pool), stripes, slots).ljust(HEADER_SIZE, b'\0'))
+            file.write(bytes(layout['bitmap'] - HEADER_SIZE))
+            # all addresses free, bits past the pool stay clear
+            file.write(b'\xff' * (len(pool) // 8))
+            if len(pool) % 8:
+                file.write(bytes([(1 << len(pool) % 8) - 1]))
+            file.truncate(layout['size'])
+        return cls(file_name)
+
+    @staticmethod
+    def layout(pool_size, stripes, slots):
+        """Get offsets of table parts in file
+        """
+        records = HEADER_SIZE
+        bitmap = records + pool_size * record.size
+        # every pool stripe owns whole bitmap bytes
+        bitmap_stripe = (-(-pool_size // stripes) + 7) // 8 * 8
+        index = bitmap + bitmap_stripe * stripes // 8
+        index += -index % 8
+        size = index + stripes * slots * slot.size
+        return {'records': records, 'bitmap': bitmap, 'bitmap_stripe': bitmap_stripe,
+                'index': index, 'size': size}
+
+    def __init__(self, file_name):
+        """Open table created with LeaseTable.create
+        """
+        self.file_name = file_name
+        self.fd = os.open(file_name, os.O_RDWR)
+        self.memory = mmap.mmap(self.fd, 0)
+        magic, version, self.first, self.pool_size, self.stripes, self.slots = header.unpack_from(self.memory)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('{} is not a lease table'.format(file_name))
+        layout = self.layout(self.pool_size, self.stripes, self.slots)
+        self.records = layout['records']
+        self.bitmap = layout['bitmap']
+        self.bitmap_stripe = layout['bitmap_stripe'] # records per pool stripe
+        self.index = layout['index']
+        # fcntl locks belong to the process, threads take this lock first
+        self.thread_lock = threading.RLock()
+        self.allocations = 0
+        self.reclaims = 0
+
+    def close(self):
+        self.memory.close()
+        os.close(self.fd)
+
+    def lock(self, offset):
+        self.thread_lock.acquire()
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, LOCK_OFFSET + offset)
+
+    def unlock(self, offset):
+        fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, LOCK_OFFSET + offset)
+        self.thread_lock.release()
+
+    def lock_index(self, stripe):
+        self.lock(stripe)
+
+    def unlock_index(self, stripe):
+        self.unlock(stripe)
+
+    def lock_pool(self, stripe):
+        self.lock(self.stripes + stripe)
+
+    def unlock_pool(self, stripe):
+        self.unlock(self.stripes + stripe)
+
+    # records
+
+    def read_record(self, index):
+        """Get (state, mac, expiry) of record, consistent even while another process writes it
+        """
+        offset = self.records + index * record.size
+        while True:
+            before, state, mac, expiry = record.unpack_from(self.memory, offset)
+            if not before & 1 and sequence.unpack_from(self.memory, offset)[0] == before:
+                return state, mac, expiry
+            os.sched_yield()
+
+    def write_record(self, index, state, mac, expiry):
+        """Change record, the pool stripe of the record must be locked
+        """
+        offset = self.records + index * record.size
+        before = sequence.unpack_from(self.memory, offset)[0]
+        sequence.pack_into(self.memory, offset, before + 1)
+        record_data.pack_into(self.memory, offset + 4, state, mac, int(expiry))
+        sequence.pack_into(self.memory, offset, before + 2)
+
+    def pool_stripe(self, index):
+        return index // self.bitmap_stripe
+
+    def set_free(self, index, free):
+        offset = self.bitmap + index // 8
+        bit = 1 << index % 8
+        self.memory[offset] = self.memory[offset] | bit if free else self.memory[offset] & ~bit
+
+    def is_free(self, index):
+        return bool(self.memory[self.bitmap + index // 8] & 1 << index % 8)
+
+    def record_index(self, ip):
+        """Get record of integer address, None if it is not in the pool
+        """
+        index = ip - self.first if ip is not None else -1
+        return index if 0 <= index < self.pool_size else None
+
+    # index
+
+    def index_position(self, mac):
+        """Get (stripe, first slot) of mac in index
+        """
+        value = mac_hash(mac)
+        return (value >> 32) % self.stripes, value & (self.slots - 1)
+
+    def find(self, mac):
+        """Get record leased or offered to mac, None if there is none
+        """
+        stripe, position = self.index_position(mac)
+        base = self.index + stripe * self.slots * slot.size
+        for probe in range(self.slots):
+            slot_mac, reference = slot.unpack_from(self.memory, base + (position + probe & self.slots - 1) * slot.size)
+            if not reference:
+                return None
+            if slot_mac == mac:
+                state, record_mac, expiry = self.read_record(reference - 1)
+                if record_mac == mac and state != FREE:
+                    return reference - 1
+        return None
+
+    def insert(self, mac, index):
+        """Point index entry of mac to record, the index stripe of mac must be locked
+        Entries of records that were reclaimed since are reused
+        """
+        stripe, position = self.index_position(mac)
+        base = self.index + stripe * self.slots * slot.size
+        target = reusable = None
+        for probe in range(self.slots):
+            offset = base + (position + probe & self.slots - 1) * slot.size
+            slot_mac, reference = slot.unpack_from(self.memory, offset)
+            if reference and slot_mac == mac:
+                target = offset
+                break
+            if not reference:
+                target = reusable if reusable is not None else offset
+                break
+            if reusable is None:
+                state, record_mac, expiry = self.read_record(reference - 1)
+                if record_mac != slot_mac or state == FREE:
+                    reusable = offset
+        else:
+            target = reusable
+        if target is None:
+            raise RuntimeError('lease index stripe {} is full'.format(stripe))
+        slot.pack_into(self.memory, target, mac, index + 1)
+
+    # allocation
+
+    def lookup(self, mac):
+        """Get (ip, state, expiry) of lease of mac, None if it has none
+        """
+        index = self.find(mac)
+        if index is None:
+            return None
+        state, record_mac, expiry = self.read_record(index)
+        return self.first + index, state, expiry
+
+    def get_by_ip(self, ip):
+        """Get (mac, state, expiry) of lease of integer address, None if it is free
+        """
+        index = self.record_index(ip)
+        if index is None:
+            return None
+        state, mac, expiry = self.read_record(index)
+        return None if state == FREE else (mac, state, expiry)
+
+    def allocate(self, mac, requested = None, expiry = 0, now = None):
+        """Get address for mac and offer it until expiry
+        The address leased or offered to mac is kept, a free requested address
+        is preferred, otherwise the first free address of the stripe of mac or
+        of the next stripes. If the pool is exhausted the lease which expired
+        first before now is taken over. Returns None if no address is left.
+        """
+        index_stripe = self.index_position(mac)[0]
+        self.lock_index(index_stripe)
+        try:
+            index = self.find(mac)
+            if index is not None:
+                if self.extend(index, mac, OFFERED, expiry):
+                    return self.first + index
+            index = self.record_index(requested)
+            if index is None or not self.claim(index, mac, expiry):
+                index = self.claim_free(mac, expiry, index_stripe)
+            if index is None:
+                index = self.reclaim(mac, expiry, time.time() if now is None else now)
+            if index is None:
+                return None
+            self.insert(mac, index)
+            self.allocations += 1
+            return self.first + index
+        finally:
+            self.unlock_index(index_stripe)
+
+    def extend(self, index, mac, state, expiry):
+        """Keep record of mac, raising state and expiry, False if it was taken meanwhile
+        """
+        pool_stripe = self.pool_stripe(index)
+        self.lock_pool(pool_stripe)
+        try:
+            old_state, record_mac, old_expiry = self.read_record(index)
+            if record_mac != mac or old_state == FREE:
+                return False
+            self.write_record(index, max(state, old_state), mac, max(expiry, old_expiry))
+            return True
+        finally:
+            self.unlock_pool(pool_stripe)
+
+    def claim(self, index, mac, expiry, state = OFFERED):
+        """Take record if it is free, False otherwise
+        """
+        pool_stripe = self.pool_stripe(index)
+        self.lock_pool(pool_stripe)
+        try:
+            if not self.is_free(index):
+                return False
+            self.set_free(index, False)
+            self.write_record(index, state, mac, expiry)
+            return True
+        finally:
+            self.unlock_pool(pool_stripe)
+
+    def claim_free(self, mac, expiry, first_stripe):
+        """Take first free record starting at stripe, None if there is none
+        """
+        stripe_bytes = self.bitmap_stripe // 8
+        for step in range(self.stripes):
+            stripe = (first_stripe + step) % self.stripes
+            start = self.bitmap + stripe * stripe_bytes
+            if not any(self.memory[start:start + stripe_bytes]):
+                continue
+            self.lock_pool(stripe)
+            try:
+                bits = self.memory[start:start + stripe_bytes]
+                free = len(bits) - len(bits.lstrip(b'\0'))
+                if free == len(bits):
+                    continue
+                index = (stripe * stripe_bytes + free) * 8 + (bits[free] & -bits[free]).bit_length() - 1
+                self.set_free(index, False)
+                self.write_record(index, OFFERED, mac, expiry)
+                return index
+            finally:
+                self.unlock_pool(stripe)
+        return None
+
+    def reclaim(self, mac, expiry, now):
+        """Take over the record which expired first before now, None if every
+        address is leased or offered until later
+        """
+        while self.pool_size:
+            records = self.memory[self.records:self.records + self.pool_size * record.size]
+            expiries = [(record_expiry, index) for index, (_, state, _, record_expiry)
+                        in enumerate(record.iter_unpack(records)) if state != FREE]
+            if not expiries:
+                # freed meanwhile
+                return self.claim_free(mac, expiry, 0)
+            expiries = [(record_expiry, index) for record_expiry, index in expiries if record_expiry < now]
+            if not expiries:
+                return None
+            oldest_expiry, index = min(expiries)
+            pool_stripe = self.pool_stripe(index)
+            self.lock_pool(pool_stripe)
+            try:
+                state, old_mac, old_expiry = self.read_record(index)
+                if state == FREE or old_expiry != oldest_expiry:
+                    continue
+                self.write_record(index, OFFERED, mac, expiry)
+                self.reclaims += 1
+                return index
+            finally:
+                self.unlock_pool(pool_stripe)
+        return None
+
+    def commit(self, mac, ip, expiry):
+        """Lease address to mac until expiry, after the client requested it
+        The address must be free or belong to mac already, an other address of
+        mac is freed. Returns False if the address is not available
+        """
+        index = self.record_index(ip)
+        if index is None:
+            return False
+        index_stripe = self.index_position(mac)[0]
+        self.lock_index(index_stripe)
+        try:
+            old_index = self.find(mac)
+            if old_index == index and self.extend(index, mac, LEASED, expiry):
+                return True
+            if not self.claim(index, mac, expiry, LEASED):
+                return False
+            if old_index is not None and old_index != index:
+                self.free(old_index, mac)
+            self.insert(mac, index)
+            return True
+        finally:
+            self.unlock_index(index_stripe)
+
+    def release(self, mac):
+        """Free address of mac, False if it has none
+        """
+        index_stripe = self.index_position(mac)[0]
+        self.lock_index(index_stripe)
+        try:
+            index = self.find(mac)
+            return index is not None and self.free(index, mac)
+        finally:
+            self.unlock_index(index_stripe)
+
+    def free(self, index, mac):
+        """Free record if it still belongs to mac
+        """
+        pool_stripe = self.pool_stripe(index)
+        self.lock_pool(pool_stripe)
+        try:
+            state, record_mac, expiry = self.read_record(index)
+            if record_mac != mac or state == FREE:
+                return False
+            self.write_record(index, FREE, 0, 0)
+            self.set_free(index, True)
+            return True
+        finally:
+            self.unlock_pool(pool_stripe)
+
+    def leases(self):
+        """Iterate over (ip, mac, state, expiry) of all used addresses
+        """
+        for index in range(self.pool_size):
+            state, mac, expiry = self.read_record(index)
+            if state != FREE:
+                yield self.first + index, mac, state, expiry
+
+    def statistics(self):
+        """Get usage of the pool, allocations and reclaims count only those of this process
+        """
+        free = bin(int.from_bytes(self.memory[self.bitmap:self.index], 'little')).count('1')
+        return {'lease_pool': self.pool_size,
+                'leases_free': free}
+
+    def __str__(self):
+        return '\n'.join('{} {} {} {}'.format(int_to_ip(ip), int_to_mac(mac), state_names[state], expiry)
+                         for ip, mac, state, expiry in self.leases())
@@ -33,11 +33,27 @@ shortpack = lambda i: bytes([i >> 8, i & 255])
 
 
 def macunpack(data):
-    s = base64.b16encode(data)
-    return ':'.join([s[i:i+2].decode('ascii') for i in range(0, 12, 2)])
+    return bytes(data[:6]).hex(':').upper()
 
 def macpack(mac):
-    return base64.b16decode(mac.replace(':', '').replace('-', '').encode('ascii'))
+    if isinstance(mac, int):
+        return mac.to_bytes(6, 'big')
+    return bytes.fromhex(mac.replace(':', '').replace('-', ''))
+
+# addresses are kept as integers internally, 32 bit IPv4 and 48 bit MAC,
+# these convert them from and to strings for configuration, logging and storage
+
+def ip_to_int(address):
+    return struct.unpack('>I', inet_aton(address))[0]
+
+def int_to_ip(address):
+    return inet_ntoa(struct.pack('>I', address))
+
+def mac_to_int(mac):
+    return int.from_bytes(macpack(mac), 'big')
+
+def int_to_mac(mac):
+    return macunpack(mac.to_bytes(6, 'big'))
 
 def unpackbool(data):
     return data[0]
@@ -141,69 +157,132 @@ assert options[64][0] == 'network_information_service_domain', options[64][0]
 assert options[76][0] == 'stda_server', options[76][0]
 
 
-class ReadBootProtocolPacket(object):
+# option number -> (name, decode, encode) for all 256 option numbers
+option_codecs = tuple(options[i] if i < len(options) else ('', None, None) for i in range(256))
 
-    for i, o in enumerate(options):
-        locals()[o[0]] = None
-        locals()['option_{0}'.format(i)] = None
+# option name or option_N -> option numbers carrying it
+option_codes = dict()
+for i, o in enumerate(option_codecs):
+    option_codes.setdefault('option_{0}'.format(i), []).append(i)
+    if o[0]:
+        option_codes.setdefault(o[0], []).append(i)
+del i, o
 
-    del i, o
+# option_overload values: fields of the BOOTP header carrying options
+OVERLOAD_FILE = 1
+OVERLOAD_SNAME = 2
+SNAME_FIELD = (44, 108)
+FILE_FIELD = (108, 236)
 
-    def __init__(self, data, address = ('0.0.0.0', 0)):
-        self.data = data
-        self.address = address
-        self.host = address[0]
-        self.port = address[1]
+# bootp_flags bit asking the server to broadcast replies, see RFC 2131 4.1
+BROADCAST_FLAG = 0x8000
 
-        # wireshark = wikipedia = data[...]
-        
-        self.message_type = self.OP =                data[0]
-        self.hardware_type = self.HTYPE =            data[1]
-        self.hardware_address_length = self.HLEN =   data[2]
-        self.hops = self.HOPS =                      data[3]
-
-        self.XID = self.transaction_id = struct.unpack('>I', data[4:8])[0]
-
-        self.seconds_elapsed = self.SECS = shortunpack(data[8:10])
-        self.bootp_flags = self.FLAGS =    shortunpack(data[8:10])
-
-        self.client_ip_address = self.CIADDR = inet_ntoa(data[12:16])
-        self.your_ip_address   = self.YIADDR = inet_ntoa(data[16:20])
-        self.next_server_ip_address = self.SIADDR = inet_ntoa(data[20:24])
-        self.relay_agent_ip_address = self.GIADDR = inet_ntoa(data[24:28])
-
-        self.client_mac_address = self.CHADDR = macunpack(data[28: 28 + self.hardware_address_length])
-        index = 236
-        self.magic_cookie = self.magic_cookie = inet_ntoa(data[index:index + 4]); index += 4
-        self.options = dict()
-        self.named_options = dict()
-        while index < len(data):
-            option = data[index]; index += 1
-            if option == 0:
-                # padding
-                # Can be used to pad other options so that they are aligned to the word boundary; is not followed by length byte
-                continue
-            if option == 255:
-                # end
-                break
-            option_length = data[index]; index += 1
-            option_data = data[index: index + option_length]; index += option_length
-            self.options[option] = option_data
-            if option < len(options):
-                option_name, function, _ = options[option]
-                if function:
-                    option_data = function(option_data)
-                if option_name:
-                    setattr(self, option_name, option_data)
-                    self.named_options[option_name] = option_data
-            setattr(self, 'option_{}'.format(option), option_data)
+def scan_options(data):
+    """Get option number -> offset of option data in datagram
+    The length of the option is the byte before its data. Options in file
+    and sname fields are included if option_overload says so, see RFC 2131 4.1
+    """
+    option_offsets = dict()
+    scan_option_field(data, 240, len(data), option_offsets)
+    offset = option_offsets.get(52)
+    if offset is not None and data[offset - 1] >= 1 and offset < len(data):
+        # truncated or empty option_overload is ignored
+        overload = data[offset]
+        if overload & OVERLOAD_FILE:
+            scan_option_field(data, FILE_FIELD[0], FILE_FIELD[1], option_offsets)
+        if overload & OVERLOAD_SNAME:
+            scan_option_field(data, SNAME_FIELD[0], SNAME_FIELD[1], option_offsets)
+    return option_offsets
+
+def scan_option_field(data, index, end, option_offsets):
+    """Record offsets of options in data[index:end] into option_offsets
+    """
+    while index < end:
+        option = data[index]; index += 1
+        if option == 0:
+            # padding
+            # Can be used to pad other options so that they are aligned to the word boundary; is not followed by length byte
+            continue
+        if option == 255 or index >= end:
+            # end
+            break
+        # option data starts after the length byte at the recorded offset
+        index += 1
+        option_offsets[option] = index
+        index += data[index - 1]
+
+class BootProtocolPacket(object):
+    """Base class of DHCP protocol datagram parsers
+    Subclasses provide the BOOTP header fields and get_option_bytes,
+    this class maps option names like subnet_mask or option_1 to properties
+    returning decoded values
+    """
+    __slots__ = ()
+
+    header_fields = ('message_type', 'hardware_type', 'hardware_address_length', 'hops',
+                     'transaction_id', 'seconds_elapsed', 'bootp_flags',
+                     'client_ip_address', 'your_ip_address', 'next_server_ip_address',
+                     'relay_agent_ip_address', 'client_mac_address', 'magic_cookie')
+
+    OP = property(lambda self: self.message_type)
+    HTYPE = property(lambda self: self.hardware_type)
+    HLEN = property(lambda self: self.hardware_address_length)
+    HOPS = property(lambda self: self.hops)
+    XID = property(lambda self: self.transaction_id)
+    SECS = property(lambda self: self.seconds_elapsed)
+    FLAGS = property(lambda self: self.bootp_flags)
+    CIADDR = property(lambda self: self.client_ip_address)
+    YIADDR = property(lambda self: self.your_ip_address)
+    SIADDR = property(lambda self: self.next_server_ip_address)
+    GIADDR = property(lambda self: self.relay_agent_ip_address)
+    CHADDR = property(lambda self: self.client_mac_address)
+
+    host = property(lambda self: self.address[0])
+    port = property(lambda self: self.address[1])
+
+    # addresses as integers read straight from the datagram
+    ciaddr = property(lambda self: struct.unpack_from('>I', self.data, 12)[0])
+    yiaddr = property(lambda self: struct.unpack_from('>I', self.data, 16)[0])
+    siaddr = property(lambda self: struct.unpack_from('>I', self.data, 20)[0])
+    giaddr = property(lambda self: struct.unpack_from('>I', self.data, 24)[0])
+    # 48 bit hardware address, longer ones are cut like in batch decoding
+    chaddr = property(lambda self: int.from_bytes(self.data[28:34], 'big'))
+
+    @property
+    def requested_ip(self):
+        """Get requested_ip_address option as integer or None
+        """
+        data = self.get_option_bytes(50)
+        if data is None or len(data) != 4:
+            return None
+        return struct.unpack('>I', data)[0]
+
+    def decode_option(self, name):
+        """Decode option by name, None if packet does not carry it
+        """
+        codes = option_codes[name]
+        # with duplicate option names the last option present wins
+        for option in reversed(codes):
+            data = self.get_option_bytes(option)
+            if data is not None:
+                function = option_codecs[option][1]
+                return function(data) if function else data
+        return None
+
+    @property
+    def named_options(self):
+        named_options = dict()
+        for option in sorted(self.options):
+            name = option_codecs[option][0]
+            if name:
+                named_options[name] = getattr(self, name)
+        return named_options
 
     def __getitem__(self, key):
-        print(key, dir(self))
         return getattr(self, key, None)
 
     def __contains__(self, key):
-        return key in self.__dict__
+        return getattr(self, key, None) is not None
 
     @property
     def formatted_named_options(self):
@@ -221,6 +300,120 @@ next server IP address: {self.next_server_ip_address}
     def __gt__(self, other):
         return id(self) < id(other)
 
+class ReadBootProtocolPacket(BootProtocolPacket):
+    """DHCP protocol datagram parser decoding the BOOTP header eagerly
+    Options are kept as raw bytes and decoded on attribute access
+    """
+    __slots__ = ('data', 'address', 'options') + BootProtocolPacket.header_fields
+
+    def __init__(self, data, address = ('0.0.0.0', 0)):
+        self.data = data
+        self.address = address
+
+        # wireshark = wikipedia = data[...]
+        
+        self.message_type =            data[0]
+        self.hardware_type =           data[1]
+        self.hardware_address_length = data[2]
+        self.hops =                    data[3]
+
+        self.transaction_id = struct.unpack('>I', data[4:8])[0]
+
+        self.seconds_elapsed = shortunpack(data[8:10])
+        self.bootp_flags =     shortunpack(data[10:12])
+
+        self.client_ip_address = inet_ntoa(data[12:16])
+        self.your_ip_address   = inet_ntoa(data[16:20])
+        self.next_server_ip_address = inet_ntoa(data[20:24])
+        self.relay_agent_ip_address = inet_ntoa(data[24:28])
+
+        self.client_mac_address = macunpack(data[28: 28 + self.hardware_address_length])
+        self.magic_cookie = inet_ntoa(data[236:240])
+        self.options = options = scan_options(data)
+        for option, index in options.items():
+            options[option] = data[index:index + data[index - 1]]
+
+    def get_option(self, name):
+        return self.decode_option(name)
+
+    def get_option_bytes(self, option):
+        """Get raw option data or None if option is not present
+        """
+        return self.options.get(option)
+
+class LazyBootProtocolPacket(BootProtocolPacket):
+    """DHCP protocol datagram parser decoding fields on first access
+    The datagram is wrapped in a memoryview and only the option offsets are
+    recorded by the constructor, integer header fields are read from the view
+    and addresses and options are decoded into decoded_fields when first used.
+    ingress is (interface index, integer local address) the datagram arrived
+    on if the receiving socket reports it, None otherwise
+    """
+    __slots__ = ('data', 'address', 'ingress', 'option_offsets', 'decoded_fields')
+
+    message_type = property(lambda self: self.data[0])
+    hardware_type = property(lambda self: self.data[1])
+    hardware_address_length = property(lambda self: self.data[2])
+    hops = property(lambda self: self.data[3])
+    transaction_id = property(lambda self: struct.unpack_from('>I', self.data, 4)[0])
+    seconds_elapsed = property(lambda self: struct.unpack_from('>H', self.data, 8)[0])
+    bootp_flags = property(lambda self: struct.unpack_from('>H', self.data, 10)[0])
+
+    header_decoders = {
+        'client_ip_address': lambda data: inet_ntoa(data[12:16]),
+        'your_ip_address': lambda data: inet_ntoa(data[16:20]),
+        'next_server_ip_address': lambda data: inet_ntoa(data[20:24]),
+        'relay_agent_ip_address': lambda data: inet_ntoa(data[24:28]),
+        'client_mac_address': lambda data: macunpack(bytes(data[28:28 + min(data[2], 16)])),
+        'magic_cookie': lambda data: inet_ntoa(data[236:240]),
+    }
+
+    def __init__(self, data, address = ('0.0.0.0', 0), ingress = None):
+        self.data = data = memoryview(data)
+        self.address = address
+        self.ingress = ingress
+        self.decoded_fields = None
+        self.option_offsets = scan_options(data)
+
+    def decode_field(self, name, decoder):
+        """Decode header field or option once and cache it
+        """
+        decoded_fields = self.decoded_fields
+        if decoded_fields is None:
+            decoded_fields = self.decoded_fields = dict()
+        elif name in decoded_fields:
+            return decoded_fields[name]
+        value = decoded_fields[name] = decoder(name)
+        return value
+
+    def get_option(self, name):
+        return self.decode_field(name, self.decode_option)
+
+    def get_option_bytes(self, option):
+        """Get raw option data or None if option is not present
+        """
+        index = self.option_offsets.get(option)
+        if index is None:
+            return None
+        return bytes(self.data[index:index + self.data[index - 1]])
+
+    @property
+    def options(self):
+        return {option: self.get_option_bytes(option) for option in self.option_offsets}
+
+def _header_property(name, decoder):
+    return property(lambda self: self.decode_field(name, lambda name: decoder(self.data)))
+
+for name, decoder in LazyBootProtocolPacket.header_decoders.items():
+    setattr(LazyBootProtocolPacket, name, _header_property(name, decoder))
+
+def _option_property(name):
+    return property(lambda self: self.get_option(name))
+
+for name in option_codes:
+    setattr(BootProtocolPacket, name, _option_property(name))
+del name, decoder
+
 data = base64.b16decode(b'02010600f7b41ad100000000c0a800640000000000000000000000007c7a914bca6c00000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000638253633501053604c0a800010104ffffff000304c0a800010604c0a80001ff00000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000'.upper())
 assert data[0] == 2
 p = ReadBootProtocolPacket(data)
@@ -236,6 +429,8 @@ assert p.your_ip_address == '0.0.0.0'
 assert p.next_server_ip_address == '0.0.0.0'
 assert p.relay_agent_ip_address == '0.0.0.0'
 assert p.client_mac_address.lower() == '7c:7a:91:4b:ca:6c'
+assert p.chaddr == 0x7c7a914bca6c and int_to_mac(p.chaddr) == p.client_mac_address
+assert p.ciaddr == ip_to_int('192.168.0.100') and int_to_ip(p.ciaddr) == p.client_ip_address
 assert p.magic_cookie == '99.130.83.99'
 assert p.dhcp_message_type == 'DHCPACK'
 assert p.options[53] == b'\x05'
@@ -244,6 +439,25 @@ assert p.subnet_mask == '255.255.255.0'
 assert p.router == ['192.168.0.1']
 assert p.domain_name_server == ['192.168.0.1']
 str(p)
+lp = LazyBootProtocolPacket(data)
+assert lp.transaction_id == p.transaction_id
+assert lp.dhcp_message_type == 'DHCPACK'
+assert lp.client_mac_address == p.client_mac_address
+assert lp.client_ip_address == p.client_ip_address
+assert lp.options == p.options
+assert lp.named_options == p.named_options
+assert lp.host_name is None and lp.option_200 is None
+assert str(lp) == str(p)
+# option_overload cut off by the end of the datagram
+data = bytes(236) + b'\x63\x82\x53\x63' + bytes([53, 1, 1, 52, 1])
+assert ReadBootProtocolPacket(data).options == {53: b'\x01', 52: b''}
+assert LazyBootProtocolPacket(data).options == {53: b'\x01', 52: b''}
+data = bytes(236) + b'\x63\x82\x53\x63' + bytes([53, 1, 1, 52, 0, 255])
+assert LazyBootProtocolPacket(data).options == {53: b'\x01', 52: b''}
+# hardware address longer than 6 bytes
+data = bytes([1, 1, 16, 0]) + bytes(24) + bytes(range(1, 17)) + bytes(192) + b'\x63\x82\x53\x63' + bytes([53, 1, 1, 255])
+assert ReadBootProtocolPacket(data).chaddr == LazyBootProtocolPacket(data).chaddr == 0x010203040506
+assert int_to_mac(LazyBootProtocolPacket(data).chaddr) == '01:02:03:04:05:06'
 
 if __name__ == '__main__':
     s1 = socket(type = SOCK_DGRAM)
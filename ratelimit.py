@@ -0,0 +1,87 @@
+"""Token bucket rate limiting of DHCP clients
+
+Every client has a bucket of burst tokens refilled at rate tokens per second,
+a packet takes one token and is dropped if the bucket is empty. A global
+bucket bounds the packets of all clients together.
+"""
+
+import collections
+import heapq
+import threading
+import time
+
+class TokenBucket(object):
+    """Bucket of at most burst tokens refilled at rate tokens per second
+    """
+    __slots__ = ('tokens', 'time', 'drops')
+
+    def __init__(self, burst, now):
+        self.tokens = burst
+        self.time = now
+        self.drops = 0
+
+    def take(self, rate, burst, now):
+        """Take one token, False if there is none left
+        """
+        self.tokens = min(burst, self.tokens + (now - self.time) * rate)
+        self.time = now
+        if self.tokens < 1:
+            self.drops += 1
+            return False
+        self.tokens -= 1
+        return True
+
+class RateLimiter(object):
+    """Per client and global token buckets
+    A rate of None disables the limit. Buckets of at most max_clients clients
+    are kept, the one unused for the longest time is forgotten first.
+    """
+    def __init__(self, client_rate = None, client_burst = 10, global_rate = None, global_burst = 1000,
+                 max_clients = 65536, clock = time.monotonic):
+        self.client_rate = client_rate
+        self.client_burst = client_burst
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+        self.max_clients = max_clients
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.clients = collections.OrderedDict() # client: TokenBucket
+        self.bucket = TokenBucket(global_burst, clock())
+        self.allowed = 0
+        self.client_drops = 0
+        self.global_drops = 0
+
+    def allow(self, client):
+        """Check if packet of client may be handled and take its tokens
+        """
+        now = self.clock()
+        with self.lock:
+            if self.client_rate is not None:
+                bucket = self.clients.get(client)
+                if bucket is None:
+                    bucket = self.clients[client] = TokenBucket(self.client_burst, now)
+                    if len(self.clients) > self.max_clients:
+                        self.clients.popitem(last = False)
+                else:
+                    self.clients.move_to_end(client)
+                if not bucket.take(self.client_rate, self.client_burst, now):
+                    self.client_drops += 1
+                    return False
+            if self.global_rate is not None and not self.bucket.take(self.global_rate, self.global_burst, now):
+                self.global_drops += 1
+                return False
+            self.allowed += 1
+            return True
+
+    def offenders(self, count = 10):
+        """Get (client, dropped packets) of clients dropped most, most first
+        """
+        with self.lock:
+            buckets = heapq.nlargest(count, self.clients.items(), key = lambda item: item[1].drops)
+        return [(client, bucket.drops) for client, bucket in buckets if bucket.drops]
+
+    def statistics(self):
+        return {'rate_limit_allowed': self.allowed,
+                'rate_limit_client_drops': self.client_drops,
+                'rate_limit_global_drops': self.global_drops,
+                'rate_limit_clients': len(self.clients)}
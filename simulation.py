@@ -0,0 +1,495 @@
+#!/usr/bin/env python3
+"""Deterministic simulation of DHCP clients served by the DHCP server
+
+The server runs on a virtual clock, its delayed responses and the clients are
+timers of one event queue and time jumps from one timer to the next, so a day
+of traffic takes as long as handling its packets. Datagrams pass through an
+in-memory transport encoded like on the network. Runs with the same seed
+produce the same packets in the same order and the same counters.
+
+Addresses are chosen from the host database like by the default server, kept
+in memory. With leases they come from a lease table in a temporary file like
+in worker processes.
+
+Simulate 50000 clients for 24 hours, lease time and delays from dhcp.conf:
+./simulation.py 50000 24 [dhcp.conf] [--leases]
+"""
+
+import collections
+import os
+import random
+import struct
+import sys
+import tempfile
+import time
+
+from dhcp import *
+
+class VirtualClock(object):
+    """Clock with the time() and monotonic() functions of the time module
+    showing simulated time, it only moves when the simulation advances it
+    """
+    def __init__(self, start = 1700000000.0):
+        self.start = start
+        self.now = 0.0 # seconds since the simulation started
+
+    def time(self):
+        return self.start + self.now
+
+    def monotonic(self):
+        return self.now
+
+class Simulation(object):
+    """Event queue of timers by virtual time, also the delay worker of the server
+    """
+    def __init__(self, clock = None, seed = 0):
+        self.clock = clock if clock is not None else VirtualClock()
+        self.timers = TimerHeap()
+        self.random = random.Random(seed)
+        self.events = 0
+
+    def do_after(self, seconds, func, args = (), kw = {}):
+        """Call function after seconds of virtual time, returns Timer
+        """
+        return self.timers.add(self.clock.now + max(0, seconds), func, args, kw)
+
+    def every(self, seconds, func):
+        """Call function every seconds of virtual time
+        """
+        def repeat():
+            func()
+            self.do_after(seconds, repeat)
+        self.do_after(seconds, repeat)
+
+    def run(self, seconds):
+        """Handle events of the next seconds of virtual time
+        """
+        until = self.clock.now + seconds
+        while True:
+            deadline = self.timers.next_deadline()
+            if deadline is None or deadline > until:
+                break
+            self.clock.now = max(self.clock.now, deadline)
+            for timer in self.timers.expire(deadline):
+                timer()
+                self.events += 1
+        self.clock.now = until
+
+    def close(self):
+        pass
+
+class MemoryTransport(object):
+    """Datagrams between clients and server delivered after latency seconds,
+    a fraction loss of them is dropped. Replies reach the client by hardware
+    address like a broadcast on one segment, broadcast ones are also seen by
+    the server in competitive delay mode. Client datagrams reach the server
+    and the other servers.
+    """
+    def __init__(self, simulation, latency = 0.001, loss = 0):
+        self.simulation = simulation
+        self.latency = latency
+        self.loss = loss
+        self.server = None
+        self.other_servers = []
+        self.clients = {} # mac: SimulatedClient
+        self.datagrams = 0
+        self.lost = 0
+
+    def _lost(self):
+        self.datagrams += 1
+        if self.loss and self.simulation.random.random() < self.loss:
+            self.lost += 1
+            return True
+        return False
+
+    def send_to_server(self, data, address = ('0.0.0.0', 68)):
+        if not self._lost():
+            self.simulation.do_after(self.latency, self._deliver_to_server, (data, address))
+
+    def send_to_client(self, data, broadcast = False):
+        if not self._lost():
+            self.simulation.do_after(self.latency, self._deliver_to_client, (data, broadcast))
+
+    def _deliver_to_server(self, data, address):
+        self.server.received(LazyBootProtocolPacket(data, address))
+        for other_server in self.other_servers:
+            other_server.received(LazyBootProtocolPacket(data, address))
+
+    def _deliver_to_client(self, data, broadcast):
+        packet = LazyBootProtocolPacket(data)
+        if broadcast and self.server.configuration.competitive_delay:
+            self.server.watched(packet)
+        client = self.clients.get(packet.chaddr)
+        if client is not None:
+            client.received(packet)
+
+class MemoryDatabase(object):
+    """Storage of HostDatabase keeping nothing, the hosts live in its index only
+    """
+    def __init__(self):
+        self.generation = 0
+
+    def state(self):
+        return self.generation
+
+    def add(self, line):
+        self.generation += 1
+
+    def delete(self, pattern):
+        self.generation += 1
+
+    def all(self):
+        return []
+
+class SimulatedDHCPServer(DHCPServer):
+    """DHCP server on the virtual clock of simulation sending to transport
+    Hosts are kept in memory, addresses come from them or with leases from a
+    lease table in a temporary file.
+    """
+    def __init__(self, configuration, simulation, transport, server_identifier = '192.168.173.1',
+                 leases = False):
+        self.simulation = simulation
+        self.transport = transport
+        self.simulated_server_identifier = server_identifier
+        self.use_leases = leases
+        self.lease_file = None
+        self.replies = collections.Counter()
+        transport.server = self
+        super().__init__(configuration, simulation.clock)
+        simulation.every(1, self.remove_done_transactions)
+
+    def create_socket(self):
+        return None
+
+    def create_delay_worker(self):
+        return self.simulation
+
+    def create_watch_socket(self):
+        return None
+
+    def create_host_database(self):
+        return HostDatabase(None, db = MemoryDatabase())
+
+    def create_lease_table(self):
+        if not self.use_leases:
+            return None
+        lease_file, self.lease_file = tempfile.mkstemp(suffix = '.leases')
+        os.close(lease_file)
+        return LeaseTable.create(self.lease_file, self.configuration.ip_address_pool())
+
+    def close(self):
+        super().close()
+        if self.lease_file is not None:
+            os.remove(self.lease_file)
+
+    def is_own_address(self, address):
+        return address == self.simulated_server_identifier
+
+    def broadcast(self, packet, request = None):
+        packet.server_identifier = self.simulated_server_identifier
+        self.replies[packet.dhcp_message_type] += 1
+        self.transport.send_to_client(packet.to_bytes(), bool(packet.bootp_flags & BROADCAST_FLAG))
+
+class OtherServer(object):
+    """Another DHCP server on the segment of transport answering at once,
+    offering the address after server_identifier to every client
+    """
+    def __init__(self, transport, configuration, server_identifier = '192.168.173.2'):
+        self.transport = transport
+        self.configuration = configuration
+        self.server_identifier = server_identifier
+        self.replies = collections.Counter()
+        transport.other_servers.append(self)
+
+    def received(self, packet):
+        if packet.dhcp_message_type == 'DHCPDISCOVER':
+            self.reply(packet, 'DHCPOFFER')
+        elif packet.dhcp_message_type == 'DHCPREQUEST' and packet.server_identifier == self.server_identifier:
+            self.reply(packet, 'DHCPACK')
+
+    def reply(self, request, message_type):
+        reply = WriteBootProtocolPacket(self.configuration)
+        reply.transaction_id = request.transaction_id
+        reply.bootp_flags = request.bootp_flags
+        reply.chaddr = request.chaddr
+        reply.yiaddr = ip_to_int(self.server_identifier) + 1
+        reply.dhcp_message_type = message_type
+        reply.server_identifier = self.server_identifier
+        self.replies[message_type] += 1
+        self.transport.send_to_client(reply.to_bytes(), bool(reply.bootp_flags & BROADCAST_FLAG))
+
+def client_packet(message_type, transaction_id, mac, ciaddr = 0, requested_ip = 0, server_identifier = None,
+                  bootp_flags = 0):
+    """Build client -> server datagram, addresses are integers
+    """
+    result = bytearray(240)
+    result[0:4] = bytes([1, 1, 6, 0])
+    struct.pack_into('>I2xHI', result, 4, transaction_id, bootp_flags, ciaddr)
+    result[28:34] = mac.to_bytes(6, 'big')
+    result[236:240] = inet_aton('99.130.83.99')
+    result += bytes([53, 1, reversed_dhcp_message_types[message_type]])
+    result += bytes([61, 7, 1]) + mac.to_bytes(6, 'big')
+    if requested_ip:
+        result += bytes([50, 4]) + requested_ip.to_bytes(4, 'big')
+    if server_identifier is not None:
+        result += bytes([54, 4]) + server_identifier
+    result += bytes([55, 4, 1, 3, 6, 51, 255])
+    result += bytes(max(0, 300 - len(result)))
+    return bytes(result)
+
+# client states, see RFC 2131 4.4
+OFFLINE = 'offline'
+SELECTING = 'selecting'
+REQUESTING = 'requesting'
+REBOOTING = 'rebooting'
+BOUND = 'bound'
+RENEWING = 'renewing'
+
+class SimulatedClient(object):
+    """DHCP client online for sessions of random length
+    It gets an address with DHCPDISCOVER and DHCPREQUEST, asks for the address
+    it had before when it comes back and renews the lease at half its time.
+    Unanswered messages are sent again after 4, 8, 16 ... seconds, after
+    max_retries the client starts over with DHCPDISCOVER.
+    """
+    max_retries = 4
+
+    def __init__(self, population, mac):
+        self.population = population
+        self.simulation = population.simulation
+        self.mac = mac
+        self.state = OFFLINE
+        self.ip = 0
+        self.server_identifier = None
+        self.transaction_id = 0
+        self.message_type = None # last message sent
+        self.started = 0 # virtual time the exchange started
+        self.retries = 0
+        self.timer = None # retransmission or renewal
+
+    def count(self, name):
+        self.population.counters[name] += 1
+
+    def schedule(self, seconds, func):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = self.simulation.do_after(seconds, func)
+
+    def send(self, message_type):
+        """Send message of the current state and wait for the reply
+        """
+        if message_type == 'DHCPDISCOVER':
+            data = client_packet(message_type, self.transaction_id, self.mac, requested_ip = self.ip)
+        elif self.state == REQUESTING:
+            data = client_packet(message_type, self.transaction_id, self.mac, requested_ip = self.ip,
+                                 server_identifier = self.server_identifier)
+        elif self.state == REBOOTING:
+            data = client_packet(message_type, self.transaction_id, self.mac, requested_ip = self.ip)
+        else:
+            data = client_packet(message_type, self.transaction_id, self.mac, ciaddr = self.ip)
+        self.message_type = message_type
+        self.count('sent_' + message_type)
+        self.population.transport.send_to_server(data, (int_to_ip(self.ip) if self.state == RENEWING else '0.0.0.0', 68))
+        self.schedule(4 * 2 ** min(self.retries, 4) + self.simulation.random.uniform(-1, 1), self.retransmit)
+
+    def retransmit(self):
+        self.timer = None
+        self.retries += 1
+        if self.retries > self.max_retries:
+            self.count('restarted_' + self.state)
+            self.discover()
+            return
+        self.count('retransmitted')
+        self.send(self.message_type)
+
+    def start(self, state):
+        self.state = state
+        self.transaction_id = self.simulation.random.getrandbits(32)
+        self.started = self.simulation.clock.now
+        self.retries = 0
+
+    def discover(self):
+        self.start(SELECTING)
+        self.send('DHCPDISCOVER')
+
+    def reboot(self):
+        self.start(REBOOTING)
+        self.send('DHCPREQUEST')
+
+    def renew(self):
+        self.start(RENEWING)
+        self.send('DHCPREQUEST')
+
+    def online(self):
+        """Come online, keep the address of the last session if there was one
+        """
+        if self.ip:
+            self.reboot()
+        else:
+            self.discover()
+
+    def offline(self):
+        """Go offline without releasing the address
+        """
+        self.state = OFFLINE
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def received(self, packet):
+        if packet.transaction_id != self.transaction_id:
+            return
+        message_type = packet.dhcp_message_type
+        self.count('received_' + message_type)
+        if self.state == SELECTING and message_type == 'DHCPOFFER':
+            self.state = REQUESTING
+            self.ip = packet.yiaddr
+            self.server_identifier = packet.get_option_bytes(54)
+            self.retries = 0
+            self.send('DHCPREQUEST')
+        elif self.state in (REQUESTING, REBOOTING, RENEWING) and message_type == 'DHCPACK':
+            self.population.latencies[self.state].append(self.simulation.clock.now - self.started)
+            self.count('bound_' + self.state)
+            if self.ip and packet.yiaddr != self.ip:
+                self.count('address_changed')
+            self.ip = packet.yiaddr
+            self.state = BOUND
+            lease_time = packet.ip_address_lease_time or self.population.configuration.ip_address_lease_time
+            self.schedule(lease_time / 2, self.renew)
+        elif message_type == 'DHCPNAK':
+            self.ip = 0
+            self.discover()
+
+class ClientPopulation(object):
+    """Clients coming online within arrival seconds, online and offline for
+    exponentially distributed times of the given means. A client coming back
+    is a new device with a new MAC address with probability replacement.
+    """
+    def __init__(self, simulation, transport, configuration, count,
+                 arrival = 600, online = 4 * 3600, offline = 2 * 3600, replacement = 0.1):
+        self.simulation = simulation
+        self.transport = transport
+        self.configuration = configuration
+        self.online_mean = online
+        self.offline_mean = offline
+        self.replacement = replacement
+        self.counters = collections.Counter()
+        self.latencies = collections.defaultdict(list) # state: seconds from first message to DHCPACK
+        self.next_mac = 0x020000000000
+        self.clients = []
+        for index in range(count):
+            client = self.new_client()
+            simulation.do_after(simulation.random.uniform(0, arrival), self.online, (client,))
+
+    def new_client(self):
+        client = SimulatedClient(self, self.next_mac)
+        self.next_mac += 1
+        self.transport.clients[client.mac] = client
+        self.clients.append(client)
+        return client
+
+    def online(self, client):
+        client.online()
+        self.simulation.do_after(self.simulation.random.expovariate(1 / self.online_mean), self.offline, (client,))
+
+    def offline(self, client):
+        client.offline()
+        if self.simulation.random.random() < self.replacement:
+            del self.transport.clients[client.mac]
+            client = self.new_client()
+        self.simulation.do_after(self.simulation.random.expovariate(1 / self.offline_mean), self.online, (client,))
+
+    def bound(self):
+        return sum(client.state in (BOUND, RENEWING) for client in self.transport.clients.values())
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def simulate(configuration, clients = 50000, hours = 24, seed = 0, latency = 0.001, loss = 0, leases = False,
+             **population):
+    """Run clients against a simulated server for hours of virtual time,
+    addresses are allocated from a lease table if leases is True
+    Returns dict of results
+    """
+    # the reply templates are shared by all servers, counted per run
+    WriteBootProtocolPacket.template_cache.clear()
+    simulation = Simulation(seed = seed)
+    transport = MemoryTransport(simulation, latency, loss)
+    server = SimulatedDHCPServer(configuration, simulation, transport, leases = leases)
+    try:
+        clients = ClientPopulation(simulation, transport, configuration, clients, **population)
+        started = time.perf_counter()
+        simulation.run(hours * 3600)
+        seconds = time.perf_counter() - started
+        results = {'virtual_seconds': hours * 3600,
+                   'wall_seconds': round(seconds, 3),
+                   'speedup': round(hours * 3600 / seconds),
+                   'events': simulation.events,
+                   'events_per_second': round(simulation.events / seconds),
+                   'datagrams': transport.datagrams,
+                   'datagrams_lost': transport.lost,
+                   'clients_bound': clients.bound()}
+        results.update(sorted(clients.counters.items()))
+        for state, latencies in sorted(clients.latencies.items()):
+            results['{}_median_s'.format(state)] = round(percentile(latencies, 0.5), 3)
+            results['{}_p99_s'.format(state)] = round(percentile(latencies, 0.99), 3)
+        results.update(('server_' + name, value) for name, value in server.statistics().items())
+        return results
+    finally:
+        server.close()
+
+def network_for(configuration, clients):
+    """Widen the network of configuration so its pool has an address for every client
+    """
+    while len(configuration.ip_address_pool()) < clients:
+        mask = ip_to_int(configuration.subnet_mask) << 1 & 0xffffffff
+        configuration.subnet_mask = int_to_ip(mask)
+        configuration.network = int_to_ip(ip_to_int(configuration.network) & mask)
+
+# competitive delay mode next to a server unicasting its replies, the clients
+# choosing it keep it alive and are not acknowledged
+_configuration = DHCPServerConfiguration()
+_configuration.competitive_delay = True
+_simulation = Simulation()
+_transport = MemoryTransport(_simulation)
+_server = SimulatedDHCPServer(_configuration, _simulation, _transport)
+_other_server = OtherServer(_transport, _configuration)
+_clients = ClientPopulation(_simulation, _transport, _configuration, 4, arrival = 1)
+_simulation.run(60)
+assert _other_server.replies['DHCPACK'] >= 4 and not _server.replies['DHCPACK'], (_other_server.replies, _server.replies)
+assert _server.other_servers.requests_for_others >= 4 and _server.other_servers.misses == {None: 0}
+# without it, unanswered broadcast requests make the minimum delay apply
+_transport.other_servers = []
+for _transaction_id in range(3):
+    _transport.send_to_server(client_packet('DHCPDISCOVER', 100 + _transaction_id, 0x020000000100 + _transaction_id))
+    _simulation.run(20)
+assert _server.other_servers.alive(None)
+for _transaction_id in range(3):
+    _transport.send_to_server(client_packet('DHCPDISCOVER', 200 + _transaction_id, 0x020000000200 + _transaction_id,
+                                            bootp_flags = BROADCAST_FLAG))
+    _simulation.run(20)
+assert not _server.other_servers.alive(None)
+assert _server.response_delay(LazyBootProtocolPacket(client_packet('DHCPDISCOVER', 300, 0x020000000300)), 10) == 0
+assert _server.replies['DHCPOFFER'] == 6, _server.replies
+# and a client coming online is served by this server
+_acknowledged = _server.replies['DHCPACK']
+_clients.online(_clients.new_client())
+_simulation.run(60)
+assert _server.replies['DHCPACK'] == _acknowledged + 1 and _clients.bound() == 5, (_server.replies, _clients.bound())
+_server.close()
+del _configuration, _simulation, _transport, _server, _other_server, _clients, _transaction_id, _acknowledged
+
+if __name__ == '__main__':
+    leases = '--leases' in sys.argv
+    arguments = [argument for argument in sys.argv if argument != '--leases']
+    configuration = DHCPServerConfiguration()
+    if len(arguments) > 3:
+        configuration.load(arguments[3])
+    clients = int(arguments[1]) if len(arguments) > 1 else 50000
+    hours = float(arguments[2]) if len(arguments) > 2 else 24
+    network_for(configuration, clients)
+    for name, value in simulate(configuration, clients, hours, leases = leases).items():
+        print('{}: {}'.format(name, value))
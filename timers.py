@@ -0,0 +1,201 @@
+"""Timer queues behind TransactionDelayWorker
+
+TimerHeap keeps timers in a binary heap, O(log n) insert and expiry.
+TimingWheel is a hashed hierarchical timing wheel, O(1) insert and cancel,
+timers fire at the first tick at or after their deadline.
+Timers are cancelled lazily from any thread, a cancelled timer drops its
+function and arguments at once and leaves the queue when it comes up.
+"""
+
+import heapq
+import math
+import time
+
+class Timer(object):
+    """Function call scheduled for deadline, seconds of time.monotonic
+    """
+    __slots__ = ('deadline', 'tick', 'call', 'cancelled')
+
+    def __init__(self, deadline, func, args = (), kw = {}):
+        self.deadline = deadline
+        self.tick = 0
+        self.call = (func, args, kw)
+        self.cancelled = False
+
+    def __call__(self):
+        # read once, cancel may run in another thread
+        call = self.call
+        if call is not None:
+            func, args, kw = call
+            return func(*args, **kw)
+
+    def cancel(self):
+        """Do not call the function, references to it and its arguments are released
+        """
+        self.cancelled = True
+        self.call = None
+
+class TimerHeap(object):
+    """Timers ordered by deadline in a binary heap
+    """
+    def __init__(self):
+        self.heap = [] # (deadline, sequence, timer)
+        self.sequence = 0
+        self.count = 0
+
+    def __len__(self):
+        """Number of queued timers, cancelled ones included until they come up
+        """
+        return self.count
+
+    def add(self, deadline, func, args = (), kw = {}):
+        """Schedule call of func at deadline, returns the Timer
+        """
+        timer = Timer(deadline, func, args, kw)
+        self.sequence += 1
+        heapq.heappush(self.heap, (deadline, self.sequence, timer))
+        self.count += 1
+        return timer
+
+    def next_deadline(self):
+        """Get time to wake up for the next timer, None if there is none
+        """
+        heap = self.heap
+        while heap and heap[0][2].cancelled:
+            heapq.heappop(heap)
+            self.count -= 1
+        return heap[0][0] if heap else None
+
+    def expire(self, now):
+        """Remove and return timers due at now in deadline order
+        """
+        heap = self.heap
+        expired = []
+        while heap and heap[0][0] <= now:
+            timer = heapq.heappop(heap)[2]
+            self.count -= 1
+            if not timer.cancelled:
+                expired.append(timer)
+        return expired
+
+class TimingWheel(object):
+    """Hashed hierarchical timing wheel, see Varghese and Lauck, "Hashed and
+    Hierarchical Timing Wheels"
+    Level 0 has a slot per tick, every higher level a slot per turn of the
+    level below, timers of a slot move down a level when its turn starts.
+    Timers beyond the last level wait in its farthest slot and are
+    inserted again when they reach level 0.
+    """
+    def __init__(self, tick = 0.001, bits = 8, levels = 4, now = None):
+        self.tick = tick
+        self.bits = bits
+        self.mask = (1 << bits) - 1
+        self.levels = [[[] for slot in range(1 << bits)] for level in range(levels)]
+        # next tick to process
+        self.current = self.tick_at(time.monotonic() if now is None else now)
+        self.count = 0
+
+    def __len__(self):
+        """Number of queued timers, cancelled ones included until they come up
+        """
+        return self.count
+
+    def tick_at(self, now):
+        """Get last tick started at now, ticks start at tick number * self.tick
+        like next_deadline computes them, the division alone may round below
+        """
+        tick = math.floor(now / self.tick)
+        if (tick + 1) * self.tick <= now:
+            tick += 1
+        return tick
+
+    def add(self, deadline, func, args = (), kw = {}):
+        """Schedule call of func at deadline, returns the Timer
+        """
+        timer = Timer(deadline, func, args, kw)
+        # first tick starting at or after deadline
+        tick = self.tick_at(deadline)
+        timer.tick = tick if tick * self.tick >= deadline else tick + 1
+        self._insert(timer)
+        self.count += 1
+        return timer
+
+    def _insert(self, timer):
+        tick = timer.tick
+        delta = tick - self.current
+        if delta <= 0:
+            self.levels[0][self.current & self.mask].append(timer)
+            return
+        level = (delta.bit_length() - 1) // self.bits
+        if level >= len(self.levels):
+            # beyond the range of the wheel
+            level = len(self.levels) - 1
+            tick = self.current + (1 << self.bits * len(self.levels)) - 1
+        self.levels[level][tick >> (self.bits * level) & self.mask].append(timer)
+
+    def next_deadline(self):
+        """Get time to wake up for the next timer or for timers moving down
+        from higher levels, None if there is none
+        """
+        if not self.count:
+            return None
+        if self.current & self.mask == 0:
+            # higher levels move down when this tick is processed
+            return self.current * self.tick
+        slots = self.levels[0]
+        for tick in range(self.current, (self.current | self.mask) + 1):
+            if slots[tick & self.mask]:
+                return tick * self.tick
+        return ((self.current | self.mask) + 1) * self.tick
+
+    def expire(self, now):
+        """Remove and return timers due at now
+        """
+        last = self.tick_at(now)
+        if not self.count:
+            self.current = max(self.current, last + 1)
+            return []
+        expired = []
+        slots = self.levels[0]
+        while self.current <= last:
+            tick = self.current
+            index = tick & self.mask
+            level = 1
+            # cascade higher levels at the start of their turn
+            while index == 0 and level < len(self.levels):
+                index = tick >> (self.bits * level) & self.mask
+                slot = self.levels[level][index]
+                self.levels[level][index] = []
+                for timer in slot:
+                    if timer.cancelled:
+                        self.count -= 1
+                    else:
+                        self._insert(timer)
+                level += 1
+            slot = slots[tick & self.mask]
+            self.current += 1
+            if slot:
+                slots[tick & self.mask] = []
+                for timer in slot:
+                    if timer.cancelled:
+                        self.count -= 1
+                    elif timer.tick > tick:
+                        # was beyond the range of the wheel
+                        self._insert(timer)
+                    else:
+                        self.count -= 1
+                        expired.append(timer)
+        return expired
+
+# a timer fires when expire is called at the deadline next_deadline returned
+for _tick in (1, 15, 16, 255, 256, 64894, 64895, 64896, 1 << 40, (1 << 40) + 64895):
+    for _delay in (0, 1, 3, 15, 16, 40, 300):
+        _wheel = TimingWheel(bits = 4, levels = 2, now = _tick * 0.001)
+        _timer = _wheel.add((_tick + _delay) * 0.001, int)
+        for _step in range(100):
+            _now = _wheel.next_deadline()
+            _expired = _wheel.expire(_now)
+            if _expired:
+                break
+        assert _expired == [_timer] and _now >= _timer.deadline, (_tick, _delay)
+del _tick, _delay, _wheel, _timer, _step, _now, _expired
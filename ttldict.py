@@ -10,13 +10,15 @@ class TTLOrderedDict(OrderedDict):
     OrderedDict with TTL
     Extra args and kwargs are passed to initial .update() call
     """
-    def __init__(self, default_ttl, *args, **kwargs):
+    def __init__(self, default_ttl, *args, clock=time.time, **kwargs):
         """
         Be warned, if you use this with Python versions earlier than 3.6
         when passing **kwargs order is not preseverd.
+        clock returns the current time in seconds.
         """
         assert isinstance(default_ttl, int)
         self._default_ttl = default_ttl
+        self._clock = clock
         self._lock = RLock()
         super().__init__()
         self.update(*args, **kwargs)
@@ -33,7 +35,7 @@ class TTLOrderedDict(OrderedDict):
     def set_ttl(self, key, ttl, now=None):
         """Set TTL for the given key"""
         if now is None:
-            now = time.time()
+            now = self._clock()
         with self._lock:
             value = self[key]
             super().__setitem__(key, (now + ttl, value))
@@ -41,7 +43,7 @@ class TTLOrderedDict(OrderedDict):
     def get_ttl(self, key, now=None):
         """Return remaining TTL for a key"""
         if now is None:
-            now = time.time()
+            now = self._clock()
         with self._lock:
             expire, _value = super().__getitem__(key)
             return expire - now
@@ -56,7 +58,7 @@ class TTLOrderedDict(OrderedDict):
         """ Check if key has expired, and return it if so"""
         with self._lock:
             if now is None:
-                now = time.time()
+                now = self._clock()
 
             expire, _value = super().__getitem__(key)
 
@@ -83,7 +85,7 @@ class TTLOrderedDict(OrderedDict):
             if self._default_ttl is None:
                 expire = None
             else:
-                expire = time.time() + self._default_ttl
+                expire = self._clock() + self._default_ttl
             super().__setitem__(key,  (expire, value))
 
     def __delitem__(self, key):